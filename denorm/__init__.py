@@ -1,5 +1,5 @@
-from denorm.fields import cached, denormalized, CountField, CacheKeyField
-from denorm.denorms import flush, rebuildall
+from denorm.fields import cached, denormalized, denormalized_expression, CountField, CacheKeyField
+from denorm.denorms import audit, compact, exact_value, flush, flush_current_transaction, rebuildall
 from denorm.dependencies import depend_on_related
 
 from django.conf import settings
@@ -14,4 +14,4 @@ if hasattr(settings, 'DENORM_FLUSH_AFTER_REQUEST') and settings.DENORM_FLUSH_AFT
         flush()
     request_finished.connect(do_flush)
 
-__all__ = ['cached', 'denormalized', 'depend_on_related', 'flush', 'rebuildall', 'CountField', 'CacheKeyField']
+__all__ = ['audit', 'cached', 'compact', 'denormalized', 'denormalized_expression', 'depend_on_related', 'exact_value', 'flush', 'flush_current_transaction', 'rebuildall', 'CountField', 'CacheKeyField']
@@ -1,16 +1,138 @@
+from decimal import Decimal
+
 from django.db import models, connections, connection
 from django.contrib.contenttypes.generic import GenericRelation
 
 
+def supports_skip_locked(connection):
+    """
+    Returns True if the database can lock rows with
+    ``SELECT ... FOR UPDATE SKIP LOCKED``.
+    """
+    return False
+
+
+def supports_transition_tables(connection):
+    """
+    Returns True if statement level triggers can read the rows changed by
+    the statement from transition tables (``REFERENCING NEW TABLE``).
+    """
+    return False
+
+
+def is_retryable(error):
+    """
+    Returns True if ``error`` aborted a transaction because of a deadlock
+    or serialization failure, so running it again may succeed.
+    """
+    return False
+
+
+def database_error(error):
+    """
+    Returns the exception raised by the database adapter for the
+    DatabaseError ``error`` raised by Django.
+    """
+    return getattr(error, '__cause__', None) or error
+
+
+def age_sql(column):
+    """
+    Returns SQL computing the number of seconds since the timestamp in ``column``.
+    """
+    raise NotImplementedError
+
+
+def key_hash_sql(value):
+    """
+    Returns SQL computing a fixed length hash of the primary key ``value``,
+    which the unique key of dirty markers is built on instead of the key.
+    """
+    raise NotImplementedError
+
+
+def aggregate_update_sql(table, pk, column, query, params, key):
+    """
+    Returns SQL and parameters setting ``column`` of every row in ``table``
+    to the ``denorm_value`` of the row of the grouped ``query`` whose ``key``
+    column equals the row's ``pk``, or to 0 if there is none.
+    Rows that already hold the right value are left alone.
+    """
+    raise NotImplementedError
+
+
+def notify_trigger(channel, using=None):
+    """
+    Returns a trigger that sends a notification on ``channel`` whenever
+    dirty markers are inserted.
+    """
+    raise NotImplementedError('Notifications are only supported by PostgreSQL')
+
+
+def listen(connection, channel):
+    """
+    Subscribes ``connection`` to notifications on ``channel``.
+    """
+    raise NotImplementedError('Notifications are only supported by PostgreSQL')
+
+
+def wait_for_notify(connection, timeout):
+    """
+    Blocks until ``connection`` receives a notification or ``timeout``
+    seconds have passed. Returns True if a notification was received.
+    """
+    raise NotImplementedError('Notifications are only supported by PostgreSQL')
+
+
 class RandomBigInt(object):
     def sql(self):
         raise NotImplementedError
 
 
+class ConnectionTag(object):
+    """
+    An integer identifying the database connection that executes the
+    trigger. Dirty markers are tagged with it, so a connection can find
+    the markers created by its own writes.
+    """
+    def sql(self):
+        raise NotImplementedError
+
+
+class StringLiteral(object):
+    def __init__(self, value):
+        self.value = value
+
+    def sql(self):
+        return "'%s'" % self.value.replace("'", "''")
+
+
+def value_sql(value):
+    if hasattr(value, 'sql'):
+        return value.sql()
+    return value
+
+
+def literal_sql(value):
+    """
+    Returns SQL for the python ``value``, for statements like trigger
+    definitions that can not take parameters.
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, long, float, Decimal)):
+        return str(value)
+    if isinstance(value, basestring):
+        return StringLiteral(value).sql()
+    raise ValueError('%r can not be used in SQL without parameters' % (value,))
+
+
 class TriggerNestedSelect:
     def __init__(self, table, columns, **kwargs):
         self.table = table
-        self.columns = ", ".join(columns)
+        self.columns = ", ".join([value_sql(column) for column in columns])
         self.kwargs = kwargs
 
     def sql(self):
@@ -18,6 +140,10 @@ class TriggerNestedSelect:
 
 
 class TriggerAction(object):
+    # The connection the action is rendered for, set by the trigger
+    # the action is appended to.
+    connection = connection
+
     def __init__(self):
         pass
 
@@ -29,30 +155,69 @@ class TriggerActionInsert(TriggerAction):
     def __init__(self, model, columns, values):
         self.model = model
         self.columns = columns
+        if isinstance(values, (list, tuple)):
+            values = tuple([value_sql(value) for value in values])
         self.values = values
 
     def sql(self):
         raise NotImplementedError
 
 
+class TriggerActionInsertSelect(TriggerAction):
+    """
+    Inserts ``values`` once for every row of ``table`` matching ``where``.
+    Unlike ``TriggerActionInsert`` rows are never skipped as duplicates.
+    """
+    def __init__(self, model, columns, values, table, where):
+        self.model = model
+        self.columns = columns
+        self.values = [value_sql(value) for value in values]
+        self.table = table
+        self.where = where
+
+    def sql(self):
+        raise NotImplementedError
+
+
 class TriggerActionUpdate(TriggerAction):
     def __init__(self, model, columns, values, where):
         self.model = model
         self.columns = columns
         self.where = where
 
+        # Values may come as (sql, params) tuples, their parameters
+        # precede the ones of ``where``.
         self.values = []
+        self.values_params = []
         for value in values:
-            if hasattr(value, 'sql'):
-                self.values.append(value.sql())
-            else:
-                self.values.append(value)
+            if isinstance(value, tuple):
+                value, params = value
+                self.values_params.extend(params)
+            self.values.append(value_sql(value))
+
+    def sql(self):
+        raise NotImplementedError
+
+
+class TriggerActionDeltaUpdate(TriggerAction):
+    """
+    Adds the sum of the ``denorm_value`` column of the rows of the
+    ``deltas`` query to ``column`` of the rows of ``model`` whose primary
+    key matches their ``denorm_key``. Used by statement level triggers.
+    """
+    def __init__(self, model, column, deltas, params):
+        self.model = model
+        self.column = column
+        self.deltas = deltas
+        self.params = params
 
     def sql(self):
         raise NotImplementedError
 
 
 class Trigger(object):
+    # Whether the trigger fires once per affected row or once per statement.
+    level = "row"
 
     def __init__(self, subject, time, event, actions, content_type, using=None, skip=None):
         self.subject = subject
@@ -60,8 +225,6 @@ class Trigger(object):
         self.event = event
         self.content_type = content_type
         self.content_type_field = None
-        self.actions = []
-        self.append(actions)
         self.using = using
 
         if self.using:
@@ -69,6 +232,9 @@ class Trigger(object):
         else:
             self.connection = connection
 
+        self.actions = []
+        self.append(actions)
+
         if isinstance(subject, models.ManyToManyField):
             self.model = None
             self.db_table = subject.m2m_db_table()
@@ -102,13 +268,14 @@ class Trigger(object):
             actions = [actions]
 
         for action in actions:
+            action.connection = self.connection
             self.actions.append(action)
 
     def name(self):
         return "_".join([
             "denorm",
             self.time,
-            "row",
+            self.level,
             self.event,
             "on",
             self.db_table
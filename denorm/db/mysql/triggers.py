@@ -3,11 +3,66 @@ import string
 from denorm.db import base
 
 
+def supports_skip_locked(connection):
+    # SKIP LOCKED was added in MySQL 8.0.1
+    return connection.mysql_version >= (8, 0, 1)
+
+
+def is_retryable(error):
+    # ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT
+    args = base.database_error(error).args
+    return bool(args) and args[0] in (1213, 1205)
+
+
+def age_sql(column):
+    return 'TIMESTAMPDIFF(SECOND, %s, CURRENT_TIMESTAMP)' % column
+
+
+def key_hash_sql(value):
+    return 'MD5(%s)' % value
+
+
+def aggregate_update_sql(table, pk, column, query, params, key):
+    # MySQL does not write rows whose value did not change.
+    return 'UPDATE %(table)s LEFT OUTER JOIN (%(query)s) AS denorm_aggregate ON denorm_aggregate.%(key)s = %(table)s.%(pk)s ' \
+        'SET %(table)s.%(column)s = COALESCE(denorm_aggregate.denorm_value, 0)' % {
+            'table': table,
+            'pk': pk,
+            'column': column,
+            'query': query,
+            'key': key,
+        }, params
+
+
+notify_trigger = base.notify_trigger
+listen = base.listen
+wait_for_notify = base.wait_for_notify
+supports_transition_tables = base.supports_transition_tables
+
+
 class RandomBigInt(base.RandomBigInt):
     def sql(self):
         return '(9223372036854775806 * ((RAND()-0.5)*2.0) )'
 
 
+class ConnectionTag(base.ConnectionTag):
+    def sql(self):
+        return 'CONNECTION_ID()'
+
+
+class StringLiteral(base.StringLiteral):
+    def sql(self):
+        # Backslashes are escape characters in MySQL string literals,
+        # unless the NO_BACKSLASH_ESCAPES SQL mode is enabled.
+        return "'%s'" % self.value.replace('\\', '\\\\').replace("'", "''")
+
+
+def literal_sql(value):
+    if isinstance(value, basestring):
+        return StringLiteral(value).sql()
+    return base.literal_sql(value)
+
+
 class TriggerNestedSelect(base.TriggerNestedSelect):
 
     def sql(self):
@@ -33,6 +88,21 @@ class TriggerActionInsert(base.TriggerActionInsert):
         return 'INSERT IGNORE INTO %(table)s %(columns)s %(values)s' % locals(), tuple()
 
 
+class TriggerActionInsertSelect(base.TriggerActionInsertSelect):
+
+    def sql(self):
+        table = self.model._meta.db_table
+        columns = ", ".join(self.columns)
+        values = ", ".join(self.values)
+        source = self.table
+        if isinstance(self.where, tuple):
+            where, where_params = self.where
+        else:
+            where, where_params = self.where, []
+
+        return 'INSERT INTO %(table)s (%(columns)s) SELECT %(values)s FROM %(source)s WHERE %(where)s' % locals(), tuple(where_params)
+
+
 class TriggerActionUpdate(base.TriggerActionUpdate):
 
     def sql(self):
@@ -43,7 +113,7 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         else:
             where, where_params = self.where, []
 
-        return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), tuple(where_params)
+        return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), tuple(self.values_params) + tuple(where_params)
 
 
 class Trigger(base.Trigger):
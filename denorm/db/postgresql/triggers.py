@@ -1,12 +1,97 @@
+import select
+
 from django.db import transaction
 from denorm.db import base
 
 
+def supports_skip_locked(connection):
+    # SKIP LOCKED was added in PostgreSQL 9.5
+    return connection.pg_version >= 90500
+
+
+def supports_on_conflict(connection):
+    # INSERT ... ON CONFLICT was added in PostgreSQL 9.5
+    return connection.pg_version >= 90500
+
+
+def supports_transition_tables(connection):
+    # REFERENCING NEW TABLE / OLD TABLE was added in PostgreSQL 10
+    return connection.pg_version >= 100000
+
+
+def is_retryable(error):
+    # deadlock_detected and serialization_failure
+    return getattr(base.database_error(error), 'pgcode', None) in ('40P01', '40001')
+
+
+def age_sql(column):
+    return 'EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - %s))' % column
+
+
+def key_hash_sql(value):
+    return 'md5(CAST(%s AS text))' % value
+
+
+def aggregate_update_sql(table, pk, column, query, params, key):
+    # UPDATE ... FROM is an inner join, rows without a related row are
+    # found by joining the table to itself.
+    return 'UPDATE %(table)s SET %(column)s = COALESCE(denorm_aggregate.denorm_value, 0) ' \
+        'FROM %(table)s AS denorm_row LEFT OUTER JOIN (%(query)s) AS denorm_aggregate ON denorm_aggregate.%(key)s = denorm_row.%(pk)s ' \
+        'WHERE %(table)s.%(pk)s = denorm_row.%(pk)s ' \
+        'AND %(table)s.%(column)s IS DISTINCT FROM COALESCE(denorm_aggregate.denorm_value, 0)' % {
+            'table': table,
+            'pk': pk,
+            'column': column,
+            'query': query,
+            'key': key,
+        }, params
+
+
+def notify_trigger(channel, using=None):
+    from denorm.models import DirtyInstance
+    # A statement level trigger sends one notification per INSERT, no
+    # matter how many rows it inserted. PostgreSQL additionally folds
+    # identical notifications of a transaction into one.
+    return StatementTrigger(DirtyInstance, "after", "insert", [TriggerActionNotify(channel)], None, using)
+
+
+def listen(connection, channel):
+    cursor = connection.cursor()
+    cursor.execute('LISTEN %s' % connection.ops.quote_name(channel))
+    transaction.commit_unless_managed(using=connection.alias)
+
+
+def wait_for_notify(connection, timeout):
+    pg_connection = connection.connection
+    pg_connection.poll()
+    if not pg_connection.notifies:
+        if select.select([pg_connection], [], [], timeout) == ([], [], []):
+            return False
+        pg_connection.poll()
+    notified = bool(pg_connection.notifies)
+    del pg_connection.notifies[:]
+    return notified
+
+
+literal_sql = base.literal_sql
+
+
 class RandomBigInt(base.RandomBigInt):
     def sql(self):
         return '(9223372036854775806::INT8 * ((RANDOM()-0.5)*2.0) )::INT8'
 
 
+class ConnectionTag(base.ConnectionTag):
+    def sql(self):
+        return 'pg_backend_pid()'
+
+
+class StringLiteral(base.StringLiteral):
+    def sql(self):
+        # untyped literals can not be used with SELECT DISTINCT before PostgreSQL 10
+        return '%s::text' % super(StringLiteral, self).sql()
+
+
 class TriggerNestedSelect(base.TriggerNestedSelect):
 
     def sql(self):
@@ -23,15 +108,31 @@ class TriggerActionInsert(base.TriggerActionInsert):
         columns = "(" + ", ".join(self.columns) + ")"
         params = []
         if isinstance(self.values, TriggerNestedSelect):
-            sql, nested_params = self.values.sql()
-            values = "(" + sql + ")"
+            values, nested_params = self.values.sql()
             params.extend(nested_params)
         else:
             values = "VALUES (" + ", ".join(self.values) + ")"
 
+        if supports_on_conflict(self.connection):
+            return 'INSERT INTO %(table)s %(columns)s %(values)s ON CONFLICT DO NOTHING' % locals(), params
+
+        # Older servers need an exception handler, which opens a
+        # subtransaction every time the trigger fires. Rows that already
+        # exist are skipped up front, so a single existing row does not
+        # abort the insert of all the others. The exception handler only
+        # covers concurrent inserts.
+        opts = self.model._meta
+        if opts.unique_together:
+            key = [opts.get_field(name).column for name in opts.unique_together[0]]
+        else:
+            key = self.columns
+        exists = " AND ".join(["%(table)s.%(column)s = new_rows.%(column)s" % {'table': table, 'column': column} for column in key])
+
         sql = (
             'BEGIN\n'
-            '    INSERT INTO %(table)s %(columns)s %(values)s;\n'
+            '    INSERT INTO %(table)s %(columns)s\n'
+            '    SELECT * FROM (%(values)s) AS new_rows %(columns)s\n'
+            '    WHERE NOT EXISTS (SELECT 1 FROM %(table)s WHERE %(exists)s);\n'
             'EXCEPTION WHEN unique_violation THEN\n'
             '    -- do nothing\n'
             'END'
@@ -39,11 +140,35 @@ class TriggerActionInsert(base.TriggerActionInsert):
         return sql, params
 
 
+class TriggerActionNotify(base.TriggerAction):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def sql(self):
+        return "PERFORM pg_notify(%s, '')" % StringLiteral(self.channel).sql(), ()
+
+
+class TriggerActionInsertSelect(base.TriggerActionInsertSelect):
+
+    def sql(self):
+        table = self.model._meta.db_table
+        columns = ", ".join(self.columns)
+        values = ", ".join(self.values)
+        source = self.table
+        if isinstance(self.where, tuple):
+            where, where_params = self.where
+        else:
+            where, where_params = self.where, []
+
+        return 'INSERT INTO %(table)s (%(columns)s) SELECT %(values)s FROM %(source)s WHERE %(where)s' % locals(), tuple(where_params)
+
+
 class TriggerActionUpdate(base.TriggerActionUpdate):
 
     def sql(self):
         table = self.model._meta.db_table
-        params = []
+        params = list(self.values_params)
         updates = ", ".join(["%s = %s" % (k, v) for k, v in zip(self.columns, self.values)])
         if isinstance(self.where, tuple):
             where, where_params = self.where
@@ -53,7 +178,25 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), params
 
 
+class TriggerActionDeltaUpdate(base.TriggerActionDeltaUpdate):
+
+    def sql(self):
+        table = self.model._meta.db_table
+        pk = self.model._meta.pk.column
+        column = self.column
+        deltas = self.deltas
+        # Parents whose rows only moved around or did not change at all
+        # are left alone.
+        return 'UPDATE %(table)s SET %(column)s = %(table)s.%(column)s + denorm_delta.denorm_value ' \
+            'FROM (SELECT denorm_key, SUM(denorm_value) AS denorm_value FROM (%(deltas)s) AS denorm_rows GROUP BY denorm_key) AS denorm_delta ' \
+            'WHERE %(table)s.%(pk)s = denorm_delta.denorm_key AND denorm_delta.denorm_value <> 0' % locals(), self.params
+
+
 class Trigger(base.Trigger):
+    # Whether statement level triggers get the changed rows in the
+    # transition tables denorm_new and denorm_old.
+    transition_tables = False
+
     def name(self):
         name = base.Trigger.name(self)
         if self.content_type_field:
@@ -80,12 +223,21 @@ class Trigger(base.Trigger):
         table = self.db_table
         time = self.time.upper()
         event = self.event.upper()
+        level = self.level.upper()
         content_type = self.content_type
         ct_field = self.content_type_field
 
         conditions = []
+        referencing = ''
 
-        if event == "UPDATE":
+        if self.transition_tables:
+            referencing = '\n    REFERENCING %s' % ' '.join(
+                '%s TABLE AS denorm_%s' % (kind, kind.lower())
+                for kind in ('OLD', 'NEW')
+                if event == 'UPDATE' or kind == {'INSERT': 'NEW', 'DELETE': 'OLD'}[event]
+            )
+
+        if event == "UPDATE" and level == "ROW":
             for field, native_type in self.fields:
                 field = qn(field)
                 if native_type is None:
@@ -98,7 +250,7 @@ class Trigger(base.Trigger):
 
             conditions = ["(%s)" % " OR ".join(conditions)]
 
-        if ct_field:
+        if ct_field and level == "ROW":
             ct_field = qn(ct_field)
             if event == "UPDATE":
                 conditions.append("(OLD.%(ctf)s = %(ct)s) OR (NEW.%(ctf)s = %(ct)s)" % {'ctf': ct_field, 'ct': content_type})
@@ -125,12 +277,29 @@ CREATE OR REPLACE FUNCTION func_%(name)s()
     END;
 $$ LANGUAGE plpgsql;
 CREATE TRIGGER %(name)s
-    %(time)s %(event)s ON %(table)s
-    FOR EACH ROW EXECUTE PROCEDURE func_%(name)s();
+    %(time)s %(event)s ON %(table)s%(referencing)s
+    FOR EACH %(level)s EXECUTE PROCEDURE func_%(name)s();
 """ % locals()
         return sql, params
 
 
+class StatementTrigger(Trigger):
+    """
+    A trigger that fires once per statement. Its actions can not refer
+    to ``NEW`` or ``OLD`` rows.
+    """
+    level = "statement"
+
+
+class TransitionTableTrigger(StatementTrigger):
+    """
+    A statement level trigger whose actions read the changed rows from
+    the ``denorm_new`` and ``denorm_old`` transition tables.
+    Requires PostgreSQL 10.
+    """
+    transition_tables = True
+
+
 class TriggerSet(base.TriggerSet):
     def drop(self):
         qn = self.connection.ops.quote_name
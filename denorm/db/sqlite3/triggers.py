@@ -1,4 +1,5 @@
 from django.db import transaction
+from django.db.backends.sqlite3.base import Database
 from denorm.db import base
 
 import logging
@@ -7,11 +8,66 @@ import logging
 logger = logging.getLogger('denorm-sqlite')
 
 
+supports_skip_locked = base.supports_skip_locked
+supports_transition_tables = base.supports_transition_tables
+
+
+def is_retryable(error):
+    return 'database is locked' in str(error)
+
+
+def age_sql(column):
+    # CURRENT_TIMESTAMP and 'now' are both UTC
+    return "(julianday('now') - julianday(%s)) * 86400" % column
+
+
+def key_hash_sql(value):
+    # SQLite indexes text of any length and does not enforce the length
+    # of the column, so the key itself is used.
+    return value
+
+
+def aggregate_update_sql(table, pk, column, query, params, key):
+    if Database.sqlite_version_info >= (3, 33, 0):
+        # UPDATE ... FROM is an inner join, rows without a related row are
+        # found by joining the table to itself.
+        return 'UPDATE %(table)s SET %(column)s = COALESCE(denorm_aggregate.denorm_value, 0) ' \
+            'FROM %(table)s AS denorm_row LEFT OUTER JOIN (%(query)s) AS denorm_aggregate ON denorm_aggregate.%(key)s = denorm_row.%(pk)s ' \
+            'WHERE %(table)s.%(pk)s = denorm_row.%(pk)s ' \
+            'AND %(table)s.%(column)s IS NOT COALESCE(denorm_aggregate.denorm_value, 0)' % {
+                'table': table,
+                'pk': pk,
+                'column': column,
+                'query': query,
+                'key': key,
+            }, params
+    value = 'COALESCE((SELECT denorm_aggregate.denorm_value FROM (%s) AS denorm_aggregate WHERE denorm_aggregate.%s = %s.%s), 0)' % (
+        query, key, table, pk)
+    return 'UPDATE %s SET %s = %s WHERE %s IS NOT %s' % (table, column, value, column, value), list(params) * 2
+
+
+notify_trigger = base.notify_trigger
+listen = base.listen
+wait_for_notify = base.wait_for_notify
+literal_sql = base.literal_sql
+
+
 class RandomBigInt(base.RandomBigInt):
     def sql(self):
         return 'RANDOM()'
 
 
+class ConnectionTag(base.ConnectionTag):
+    def sql(self):
+        # SQLite has a single writer at a time and no way to tell
+        # connections apart, all markers share the same tag.
+        return '0'
+
+
+class StringLiteral(base.StringLiteral):
+    pass
+
+
 class TriggerNestedSelect(base.TriggerNestedSelect):
 
     def sql(self):
@@ -33,7 +89,22 @@ class TriggerActionInsert(base.TriggerActionInsert):
             values = "VALUES(" + ", ".join(self.values) + ")"
             params = []
 
-        return 'INSERT OR REPLACE INTO %(table)s %(columns)s %(values)s' % locals(), tuple(params)
+        return 'INSERT OR IGNORE INTO %(table)s %(columns)s %(values)s' % locals(), tuple(params)
+
+
+class TriggerActionInsertSelect(base.TriggerActionInsertSelect):
+
+    def sql(self):
+        table = self.model._meta.db_table
+        columns = ", ".join(self.columns)
+        values = ", ".join(self.values)
+        source = self.table
+        if isinstance(self.where, tuple):
+            where, where_params = self.where
+        else:
+            where, where_params = self.where, []
+
+        return 'INSERT INTO %(table)s (%(columns)s) SELECT %(values)s FROM %(source)s WHERE %(where)s' % locals(), tuple(where_params)
 
 
 class TriggerActionUpdate(base.TriggerActionUpdate):
@@ -46,7 +117,7 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         else:
             where, where_params = self.where, []
 
-        return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), where_params
+        return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), list(self.values_params) + list(where_params)
 
 
 class Trigger(base.Trigger):
@@ -1,13 +1,26 @@
 # -*- coding: utf-8 -*-
 import abc
+import logging
+import multiprocessing
+import random
+import time
+import traceback
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from denorm import metrics
 from denorm.db import triggers
-from django.db import connections, connection
-from django.db.models import sql, ManyToManyField
-from django.db.models.aggregates import Sum
+from django.db import connections, connection, router, transaction, DatabaseError
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+from django.db.models import get_model, sql, ManyToManyField
+from django.db.models.aggregates import Count, Max, Min, Sum
 from django.db.models.manager import Manager
-from denorm.models import DirtyInstance
+from denorm.models import AggregateDelta, DirtyInstance, RebuildCheckpoint
+from denorm.dependencies import dirty_instance_action
 from django.db.models.query_utils import Q
 from django.db.models.sql.compiler import SQLCompiler
 from django.db.models.sql.constants import JoinInfo
@@ -18,6 +31,32 @@ from django.db.models.sql.where import WhereNode
 # This is used to rebuild all denormalized values in the whole DB.
 alldenorms = []
 
+# Number of dirty markers handled at once by flush().
+FLUSH_CHUNK_SIZE = 500
+
+# How often flush() revisits a group of mutually dependent models
+# within one pass before moving on to the next group.
+FLUSH_MAX_ITERATIONS = 10
+
+# How many passes flush() makes at most. Denormalizations marking each
+# other dirty in a cycle would keep it busy forever otherwise.
+FLUSH_MAX_PASSES = 100
+
+# How often flush() retries a chunk that failed because of a deadlock or
+# serialization failure, and the base delay between those retries in seconds.
+FLUSH_RETRIES = 5
+FLUSH_RETRY_DELAY = 0.05
+
+# Number of instances recomputed per transaction by rebuildall().
+REBUILD_CHUNK_SIZE = 500
+
+# How often rebuildall() retries a primary key range that failed in a
+# worker process, and how many ranges per worker it splits every model into.
+REBUILD_RETRIES = 3
+REBUILD_RANGES_PER_JOB = 4
+
+logger = logging.getLogger(__name__)
+
 
 def many_to_many_pre_save(sender, instance, **kwargs):
     """
@@ -61,6 +100,13 @@ def many_to_many_post_save(sender, instance, created, **kwargs):
 
 
 class Denorm(object):
+    # Computes the values of a list of instances at once, if set.
+    batch_func = None
+    # A ``(queryset or callable returning one, foreign key name)`` pair
+    # computing the value in the database, if set.
+    # See ``denormalized_expression``.
+    expression = None
+
     def __init__(self, skip=None):
         self.func = None
         self.skip = skip
@@ -82,9 +128,39 @@ class Denorm(object):
             if not self.model._meta.swapped:
                 alldenorms.append(self)
 
-    def update(self, instance):
+    def get_values(self, instances):
+        """
+        Returns a dictionary mapping the primary keys of ``instances``
+        to their computed values.
+        """
+        if self.batch_func is None:
+            return dict((instance.pk, self.func(instance)) for instance in instances)
+        values = self.batch_func(instances)
+        default = self.model._meta.get_field(self.fieldname).get_default()
+        return dict((instance.pk, values.get(instance.pk, default)) for instance in instances)
+
+    def is_stale(self, instance, values=None):
+        """
+        Returns whether the value stored in ``instance`` differs from the
+        one ``func`` computes, without changing anything.
+        The value is taken from the ``values`` of ``get_values()`` if given.
+        """
+        field = instance._meta.get_field(self.fieldname)
+        attr = getattr(instance, field.attname)
+        new_value = values[instance.pk] if values is not None else self.func(instance)
+
+        if isinstance(attr, Manager):
+            old_pks = set([x.pk for x in attr.all()])
+            new_pks = set([getattr(x, 'pk', x) for x in new_value])
+            return old_pks != new_pks
+        if hasattr(field, 'related_field') and isinstance(new_value, field.related_field.model):
+            new_value = getattr(new_value, field.related_field.attname)
+        return attr != new_value
+
+    def update(self, instance, values=None):
         """
         Updates the denormalizations in all instances in the queryset 'qs'.
+        The value is taken from the ``values`` of ``get_values()`` if given.
         """
 
         # Get attribute name (required for denormalising ForeignKeys)
@@ -94,7 +170,7 @@ class Denorm(object):
         attr = getattr(instance, attname)
 
         # only write new values to the DB if they actually changed
-        new_value = self.func(instance)
+        new_value = values[instance.pk] if values is not None else self.func(instance)
 
         if isinstance(attr, Manager):
             # for a many to many field the decorated
@@ -126,6 +202,79 @@ class Denorm(object):
     def get_triggers(self, using):
         return []
 
+    def get_expression(self):
+        """
+        Returns the queryset and the foreign key name of the ``expression``,
+        building the queryset if a callable was given.
+        """
+        queryset, outer_ref = self.expression
+        if callable(queryset):
+            queryset = queryset()
+        return queryset, outer_ref
+
+    def get_expression_sql(self, using, literal_default=False):
+        """
+        Returns SQL and parameters of a subquery computing the value of
+        the row of ``self.model`` it is used in from the ``expression``.
+        With ``literal_default`` the default of the field is part of the
+        SQL instead of the parameters, as needed inside triggers.
+        """
+        qn = self.get_quote_name(using)
+        queryset, outer_ref = self.get_expression()
+        foreign_key = queryset.model._meta.get_field(outer_ref)
+        queryset = queryset.extra(where=['%s.%s = %s.%s' % (
+            qn(queryset.model._meta.db_table), qn(foreign_key.column),
+            qn(self.model._meta.db_table), qn(self.model._meta.pk.column),
+        )])[:1]
+        sql, params = queryset.query.get_compiler(using=using or 'default').as_sql()
+        # The subquery refers to the outer row by the name of its table,
+        # any use of that table inside would capture the reference.
+        if self.model._meta.db_table in [join.table_name for join in queryset.query.alias_map.values()]:
+            raise ValueError('The expression of %s.%s can not select from or join its own model' % (self.model._meta, self.fieldname))
+
+        field = self.model._meta.get_field(self.fieldname)
+        if field.has_default():
+            if using:
+                cconnection = connections[using]
+            else:
+                cconnection = connection
+            default = field.get_db_prep_save(field.get_default(), connection=cconnection)
+            if literal_default:
+                return 'COALESCE((%s), %s)' % (sql, triggers.literal_sql(default)), tuple(params)
+            return 'COALESCE((%s), %%s)' % sql, tuple(params) + (default,)
+        return '(%s)' % sql, tuple(params)
+
+    def update_expression(self, pks, using=None):
+        """
+        Sets the value of the instances with the given primary keys from
+        the ``expression`` with one ``UPDATE`` per batch, and returns the
+        number of updated rows.
+        """
+        if not pks:
+            return 0
+        if using:
+            cconnection = connections[using]
+        else:
+            cconnection = connection
+        qn = self.get_quote_name(using)
+        opts = self.model._meta
+
+        expression, params = self.get_expression_sql(using)
+        batch_size = max(cconnection.ops.bulk_batch_size([None] * (1 + len(params)), pks), 1)
+        cursor = cconnection.cursor()
+        count = 0
+        for offset in range(0, len(pks), batch_size):
+            batch = pks[offset:offset + batch_size]
+            cursor.execute('UPDATE %s SET %s = %s WHERE %s IN (%s)' % (
+                qn(opts.db_table),
+                qn(opts.get_field(self.fieldname).column),
+                expression,
+                qn(opts.pk.column),
+                ', '.join(['%s'] * len(batch)),
+            ), list(params) + [opts.pk.get_db_prep_value(pk, connection=cconnection) for pk in batch])
+            count += cursor.rowcount
+        return count
+
 
 class BaseCallbackDenorm(Denorm):
     """
@@ -174,10 +323,8 @@ class CallbackDenorm(BaseCallbackDenorm):
         # using the ORM or if it was part of a bulk update.
         # In those cases the self_save_handler won't get called by the
         # pre_save signal, so we need to ensure flush() does this later.
-        action = triggers.TriggerActionInsert(
-            model=DirtyInstance,
-            columns=("content_type_id", "object_id"),
-            values=(content_type, "NEW.%s" % qn(self.model._meta.pk.get_attname_column()[1]))
+        action = dirty_instance_action(
+            self.model, content_type, "NEW.%s" % qn(self.model._meta.pk.get_attname_column()[1]),
         )
         trigger_list = [
             triggers.Trigger(self.model, "after", "update", [action], content_type, using, self.skip),
@@ -187,6 +334,58 @@ class CallbackDenorm(BaseCallbackDenorm):
         return trigger_list + super(CallbackDenorm, self).get_triggers(using=using)
 
 
+class TriggerExpressionDenorm(Denorm):
+    """
+    Keeps the value of an ``expression`` up to date from within triggers
+    on the model the expression selects from, so changes are visible as
+    soon as they are committed, without dirty markers or ``flush()``.
+    """
+
+    @staticmethod
+    def check_queryset(queryset, using=None):
+        """
+        Raises ``NotImplementedError`` if the triggers can not run the
+        ``queryset`` on the database.
+        """
+        if using:
+            cconnection = connections[using]
+        else:
+            cconnection = connection
+        if cconnection.vendor == 'sqlite' and queryset.query.get_compiler(using=using or 'default').as_sql()[1]:
+            raise NotImplementedError('filters for immediate expression fields are currently not supported for sqlite')
+
+    def get_expression(self):
+        queryset, outer_ref = super(TriggerExpressionDenorm, self).get_expression()
+        self.check_queryset(queryset)
+        return queryset, outer_ref
+
+    def get_triggers(self, using):
+        qn = self.get_quote_name(using)
+
+        queryset, outer_ref = self.get_expression()
+        self.check_queryset(queryset, using)
+        foreign_key = queryset.model._meta.get_field(outer_ref)
+        expression, params = self.get_expression_sql(using, literal_default=True)
+
+        content_type = str(ContentType.objects.get_for_model(self.model).pk)
+
+        # Recompute the value of the instances a row is related to
+        # before and after the change.
+        actions = dict((alias, triggers.TriggerActionUpdate(
+            model=self.model,
+            columns=(qn(self.model._meta.get_field(self.fieldname).column),),
+            values=((expression, params),),
+            where="%s = %s.%s" % (qn(self.model._meta.pk.column), alias, qn(foreign_key.column)),
+        )) for alias in ('NEW', 'OLD'))
+
+        other_model = queryset.model
+        return [
+            triggers.Trigger(other_model, "after", "update", [actions['NEW'], actions['OLD']], content_type, using, self.skip),
+            triggers.Trigger(other_model, "after", "insert", [actions['NEW']], content_type, using, self.skip),
+            triggers.Trigger(other_model, "after", "delete", [actions['OLD']], content_type, using, self.skip),
+        ]
+
+
 class BaseCacheKeyDenorm(Denorm):
     def __init__(self, depend_on_related, *args, **kwargs):
         self.depend = depend_on_related
@@ -285,6 +484,7 @@ class AggregateDenorm(Denorm):
     def __init__(self, skip=None):
         self.manager = None
         self.skip = skip
+        self.deferred = False
 
     def setup(self, sender, **kwargs):
         # as we connected to the ``class_prepared`` signal for any sender
@@ -353,6 +553,13 @@ class AggregateDenorm(Denorm):
         qn = self.get_quote_name(using)
 
         related_field = self.manager.related.field
+        if self.deferred and (isinstance(related_field, ManyToManyField) or not DirtyInstance.has_integer_key(self.model)):
+            raise NotImplementedError('deferred aggregate fields are only supported for ForeignKeys to models with integer primary keys')
+        if (not self.deferred and getattr(settings, 'DENORM_STATEMENT_TRIGGERS', False) and
+                not isinstance(related_field, ManyToManyField) and
+                triggers.supports_transition_tables(cconnection)):
+            return self.get_statement_triggers(using)
+
         if isinstance(related_field, ManyToManyField):
             fk_name = related_field.m2m_reverse_name()
             inc_where = ["%(id)s IN (SELECT %(reverse_related)s FROM %(m2m_table)s WHERE %(related)s = NEW.%(id)s)" % {
@@ -386,23 +593,41 @@ class AggregateDenorm(Denorm):
             inc_where.append(inc_filter_where)
         if dec_filter_where:
             dec_where.append(dec_filter_where)
+        if self.deferred:
+            # append the changes to the pending deltas
+            increment = self.get_delta_action((' AND '.join(inc_where), where_params), 'NEW', '', content_type, using)
+            decrement = self.get_delta_action((' AND '.join(dec_where), where_params), 'OLD', '-', content_type, using)
+            # Updates that neither move the row to an other instance nor
+            # change its value would record a pair of deltas cancelling
+            # each other out, skip them.
+            unchanged = ["NEW.%s = OLD.%s" % (fk_name, fk_name)]
+            unchanged += [where for where in (inc_filter_where, dec_filter_where) if where]
+            unchanged.append("COALESCE(%s, 0) = COALESCE(%s, 0)" % (self.get_delta_value('NEW', using), self.get_delta_value('OLD', using)))
+            changed = "NOT COALESCE(%s, FALSE)" % ' AND '.join(unchanged)
+            changed_params = list(where_params) * (len(unchanged) - 2)
+            update_actions = [
+                self.get_delta_action((' AND '.join(inc_where + [changed]), list(where_params) + changed_params), 'NEW', '', content_type, using),
+                self.get_delta_action((' AND '.join(dec_where + [changed]), list(where_params) + changed_params), 'OLD', '-', content_type, using),
+            ]
+        else:
             # create the triggers for the incremental updates
-        increment = triggers.TriggerActionUpdate(
-            model=self.model,
-            columns=(self.fieldname,),
-            values=(self.get_increment_value(using),),
-            where=(' AND '.join(inc_where), where_params),
-        )
-        decrement = triggers.TriggerActionUpdate(
-            model=self.model,
-            columns=(self.fieldname,),
-            values=(self.get_decrement_value(using),),
-            where=(' AND '.join(dec_where), where_params),
-        )
+            increment = triggers.TriggerActionUpdate(
+                model=self.model,
+                columns=(self.fieldname,),
+                values=(self.get_increment_value(using),),
+                where=(' AND '.join(inc_where), where_params),
+            )
+            decrement = triggers.TriggerActionUpdate(
+                model=self.model,
+                columns=(self.fieldname,),
+                values=(self.get_decrement_value(using),),
+                where=(' AND '.join(dec_where), where_params),
+            )
+            update_actions = [increment, decrement]
 
         other_model = self.manager.related.model
         trigger_list = [
-            triggers.Trigger(other_model, "after", "update", [increment, decrement], content_type, using, self.skip),
+            triggers.Trigger(other_model, "after", "update", update_actions, content_type, using, self.skip),
             triggers.Trigger(other_model, "after", "insert", [increment], content_type, using, self.skip),
             triggers.Trigger(other_model, "after", "delete", [decrement], content_type, using, self.skip),
         ]
@@ -410,6 +635,110 @@ class AggregateDenorm(Denorm):
             trigger_list.extend(self.m2m_triggers(content_type, fk_name, related_field, using))
         return trigger_list
 
+    def get_delta_action(self, where, alias, sign, content_type, using):
+        """
+        Returns a trigger action recording the change made by the ``alias``
+        row as a pending delta of the instance matching ``where``.
+        """
+        qn = self.get_quote_name(using)
+
+        table = qn(self.model._meta.db_table)
+        return triggers.TriggerActionInsertSelect(
+            model=AggregateDelta,
+            columns=("content_type_id", "object_id", "field_name", "delta"),
+            values=(
+                content_type,
+                "%s.%s" % (table, qn(self.model._meta.pk.column)),
+                triggers.StringLiteral(self.fieldname),
+                "%sCOALESCE(%s, 0)" % (sign, self.get_delta_value(alias, using)),
+            ),
+            table=table,
+            where=where,
+        )
+
+    def get_pending_sql(self, using):
+        """
+        Returns SQL and parameters of a subquery summing up the pending
+        deltas of the row of ``self.model`` it is used in.
+        """
+        qn = self.get_quote_name(using)
+
+        if not self.deferred:
+            return '0', []
+        return 'COALESCE((SELECT SUM(%(delta)s) FROM %(deltas)s WHERE %(content_type_id)s = %%s AND %(field_name)s = %%s ' \
+            'AND %(object_id)s = %(table)s.%(pk)s), 0)' % {
+                'delta': qn('delta'),
+                'deltas': qn(AggregateDelta._meta.db_table),
+                'content_type_id': qn('content_type_id'),
+                'field_name': qn('field_name'),
+                'object_id': qn('object_id'),
+                'table': qn(self.model._meta.db_table),
+                'pk': qn(self.model._meta.pk.column),
+            }, [ContentType.objects.get_for_model(self.model).pk, self.fieldname]
+
+    def is_stale(self, instance, values=None):
+        if not self.deferred:
+            return super(AggregateDenorm, self).is_stale(instance, values)
+        new_value = values[instance.pk] if values is not None else self.func(instance)
+        return exact_value(instance, self.fieldname) != new_value
+
+    def get_statement_triggers(self, using):
+        """
+        Returns statement level triggers, which apply the changes of all
+        rows written by a statement with one grouped update per parent.
+        """
+        if using:
+            cconnection = connections[using]
+        else:
+            cconnection = connection
+
+        qn = self.get_quote_name(using)
+
+        other_model = self.manager.related.model
+        fk_name = qn(self.manager.related.field.column)
+
+        def deltas(alias, sign):
+            query = TriggerFilterQuery(other_model, trigger_alias=alias)
+            query.add_q(Q(**self.filter))
+            query.add_q(~Q(**self.exclude))
+            filter_where, params = query.where.as_sql(
+                SQLCompiler(query, cconnection, using).quote_name_unless_alias, cconnection)
+            sql = 'SELECT %s.%s AS denorm_key, %s(%s) AS denorm_value FROM %s' % (
+                alias, fk_name, sign, self.get_delta_value(alias, using), alias)
+            if filter_where:
+                sql += ' WHERE ' + filter_where
+            return sql, list(params)
+
+        column = qn(self.model._meta.get_field(self.fieldname).column)
+        increment, increment_params = deltas('denorm_new', '')
+        decrement, decrement_params = deltas('denorm_old', '-')
+        content_type = str(ContentType.objects.get_for_model(self.model).pk)
+
+        def action(*queries):
+            return triggers.TriggerActionDeltaUpdate(
+                model=self.model,
+                column=column,
+                deltas=' UNION ALL '.join(sql for sql, params in queries),
+                params=sum([params for sql, params in queries], []),
+            )
+
+        return [
+            triggers.TransitionTableTrigger(other_model, "after", "update",
+                [action((increment, increment_params), (decrement, decrement_params))],
+                content_type, using, self.skip),
+            triggers.TransitionTableTrigger(other_model, "after", "insert",
+                [action((increment, increment_params))], content_type, using, self.skip),
+            triggers.TransitionTableTrigger(other_model, "after", "delete",
+                [action((decrement, decrement_params))], content_type, using, self.skip),
+        ]
+
+    @abc.abstractmethod
+    def get_delta_value(self, alias, using):
+        """
+        Returns SQL for the change a row of the transition table ``alias``
+        makes to the value
+        """
+
     @abc.abstractmethod
     def get_increment_value(self, using):
         """
@@ -422,6 +751,93 @@ class AggregateDenorm(Denorm):
         Returns SQL for decrementing value
         """
 
+    @abc.abstractmethod
+    def get_aggregate(self):
+        """
+        Returns the aggregate computing the value from the related rows
+        """
+
+    def get_aggregate_query(self, using):
+        """
+        Returns SQL and parameters of a query computing the value for every
+        instance that has related rows, with the primary key of the instance
+        in the returned column and the value in ``denorm_value``, as well as
+        the name of that column.
+        """
+        related_field = self.manager.related.field
+        if isinstance(related_field, ManyToManyField):
+            key = related_field.m2m_reverse_name()
+        else:
+            key = related_field.column
+        queryset = self.manager.related.model._base_manager.all()
+        if using:
+            queryset = queryset.using(using)
+        queryset = queryset.filter(**self.filter).exclude(**self.exclude).order_by()
+        queryset = queryset.values(related_field.name).annotate(denorm_value=self.get_aggregate())
+        query, params = queryset.query.sql_with_params()
+        return query, params, key
+
+    def rebuild(self, using=None):
+        """
+        Recomputes the value for all instances with a single statement,
+        instead of calling ``func`` for each of them.
+        """
+        if using:
+            cconnection = connections[using]
+        else:
+            cconnection = connection
+        qn = self.get_quote_name(using)
+
+        if self.deferred:
+            # The recomputed value already includes the pending deltas.
+            AggregateDelta.objects.using(using or 'default').filter(
+                content_type=ContentType.objects.get_for_model(self.model),
+                field_name=self.fieldname,
+            ).delete()
+
+        query, params, key = self.get_aggregate_query(using)
+        sql, params = triggers.aggregate_update_sql(
+            qn(self.model._meta.db_table),
+            qn(self.model._meta.pk.column),
+            qn(self.model._meta.get_field(self.fieldname).column),
+            query, params, qn(key),
+        )
+        cconnection.cursor().execute(sql, params)
+
+    def find_drift(self, limit, using=None):
+        """
+        Returns the number of instances whose stored value differs from the
+        computed one and the primary keys of up to ``limit`` of them,
+        with two read-only queries.
+        """
+        if using:
+            cconnection = connections[using]
+        else:
+            cconnection = connection
+        qn = self.get_quote_name(using)
+
+        query, params, key = self.get_aggregate_query(using)
+        pending, pending_params = self.get_pending_sql(using)
+        sql = 'FROM %(table)s LEFT OUTER JOIN (%(query)s) AS denorm_aggregate ' \
+            'ON denorm_aggregate.%(key)s = %(table)s.%(pk)s ' \
+            'WHERE %(table)s.%(column)s + %(pending)s <> COALESCE(denorm_aggregate.denorm_value, 0)' % {
+                'table': qn(self.model._meta.db_table),
+                'pk': qn(self.model._meta.pk.column),
+                'column': qn(self.model._meta.get_field(self.fieldname).column),
+                'pending': pending,
+                'query': query,
+                'key': qn(key),
+            }
+        params = list(params) + list(pending_params)
+        cursor = cconnection.cursor()
+        cursor.execute('SELECT COUNT(*) ' + sql, params)
+        count = cursor.fetchone()[0]
+        cursor.execute('SELECT %s.%s %s ORDER BY %s.%s LIMIT %%s' % (
+            qn(self.model._meta.db_table), qn(self.model._meta.pk.column), sql,
+            qn(self.model._meta.db_table), qn(self.model._meta.pk.column),
+        ), list(params) + [limit])
+        return count, [row[0] for row in cursor.fetchall()]
+
 
 class SumDenorm(AggregateDenorm):
     """
@@ -445,6 +861,14 @@ class SumDenorm(AggregateDenorm):
 
         return "%s - OLD.%s" % (qn(self.fieldname), qn(self.sum_field))
 
+    def get_delta_value(self, alias, using):
+        qn = self.get_quote_name(using)
+
+        return "%s.%s" % (alias, qn(self.sum_field))
+
+    def get_aggregate(self):
+        return Sum(self.sum_field)
+
     def get_related_increment_value(self, using):
         qn = self.get_quote_name(using)
 
@@ -495,6 +919,12 @@ class CountDenorm(AggregateDenorm):
 
         return "%s - 1" % qn(self.fieldname)
 
+    def get_delta_value(self, alias, using):
+        return "1"
+
+    def get_aggregate(self):
+        return Count('pk')
+
     def get_related_increment_value(self, using):
         return self.get_increment_value(using)
 
@@ -502,10 +932,66 @@ class CountDenorm(AggregateDenorm):
         return self.get_decrement_value(using)
 
 
-def rebuildall(verbose=False, model_name=None, field_name=None):
+def rebuildall(verbose=False, model_name=None, field_name=None, chunk_size=None, jobs=1, resume=False):
     """
     Updates all models containing denormalized fields.
     Used by the 'denormalize' management command.
+
+    Every model is walked in chunks of ``chunk_size`` instances ordered by
+    primary key, each recomputed and written back in a transaction of its own.
+    Count and sum fields are recomputed by a single statement instead.
+    With ``jobs`` greater than one, the primary keys of every model are split
+    into ranges that are rebuilt by a pool of that many processes.
+
+    Progress is checkpointed after every chunk. With ``resume`` an interrupted
+    rebuild continues after its last checkpoint, otherwise it starts over.
+    """
+    models = select_denorms(model_name, field_name)
+    # Checkpoints of rebuilds of other fields are left alone.
+    checkpoints = get_checkpoints(models)
+
+    if not resume:
+        checkpoints.delete()
+
+    # Aggregates are recomputed for all instances by a single statement,
+    # only the remaining denormalizations need to visit every instance.
+    for model, denorms in models.items():
+        for denorm in denorms:
+            if isinstance(denorm, AggregateDenorm):
+                checkpoint = get_checkpoint(model, [denorm])
+                if checkpoint.done:
+                    continue
+                if verbose:
+                    print 'rebuilding', denorm.fieldname, 'in', model
+
+                def rebuild_aggregate():
+                    denorm.rebuild()
+                    checkpoint.done = True
+                    checkpoint.save()
+                run_in_transaction(rebuild_aggregate)
+        models[model] = [denorm for denorm in denorms if not isinstance(denorm, AggregateDenorm)]
+        if not models[model]:
+            del models[model]
+
+    if jobs > 1:
+        rebuild_parallel(models, chunk_size, jobs, verbose)
+    else:
+        i = 0
+        for model, denorms in models.items():
+            if verbose:
+                for denorm in denorms:
+                    print 'rebuilding', '%s/%s' % (i + 1, len(alldenorms)), denorm.fieldname, 'in', model
+                    i += 1
+            rebuild_model(model, denorms, chunk_size, checkpoint=get_checkpoint(model, denorms))
+
+    flush()
+    checkpoints.delete()
+
+
+def select_denorms(model_name=None, field_name=None):
+    """
+    Returns a dictionary mapping every model to the list of its
+    denormalizations, optionally limited to a model or app and a field.
     """
     global alldenorms
     models = {}
@@ -516,25 +1002,276 @@ def rebuildall(verbose=False, model_name=None, field_name=None):
         if model_name is None or model_name in (current_app_label, current_model_name, current_app_model):
             if field_name is None or field_name == denorm.fieldname:
                 models.setdefault(denorm.model, []).append(denorm)
+    return models
+
 
-    i = 0
+def get_checkpoints(models):
+    """
+    Returns the checkpoints of rebuilding the denormalizations in the
+    ``models`` dictionary returned by ``select_denorms()``.
+    Aggregates are checkpointed one by one, all other denormalizations
+    of a model together.
+    """
+    query = Q(pk=None)
     for model, denorms in models.items():
-        if verbose:
-            for denorm in denorms:
-                print 'rebuilding', '%s/%s' % (i + 1, len(alldenorms)), denorm.fieldname, 'in', model
-                i += 1
-        for instance in model.objects.all():
-            fields = {}
-            save = False
-            for denorm in denorms:
-                _fields = denorm.update(instance)
-                if _fields is not None:
-                    fields.update(_fields)
-                    save = True
-            if save:
-                model.objects.filter(pk=instance.pk).update(**fields)
+        field_names = [denorm.fieldname for denorm in denorms if isinstance(denorm, AggregateDenorm)]
+        others = [denorm.fieldname for denorm in denorms if not isinstance(denorm, AggregateDenorm)]
+        if others:
+            field_names.append(','.join(sorted(others)))
+        query |= Q(content_type=ContentType.objects.get_for_model(model), field_names__in=field_names)
+    return RebuildCheckpoint.objects.filter(query)
 
-    flush()
+
+def get_checkpoint(model, denorms, min_pk=None, max_pk=None):
+    """
+    Returns the checkpoint of rebuilding ``denorms`` for the instances of
+    ``model`` with a primary key between ``min_pk`` and ``max_pk``.
+    """
+    checkpoint, created = RebuildCheckpoint.objects.get_or_create(
+        content_type=ContentType.objects.get_for_model(model),
+        field_names=','.join(sorted(denorm.fieldname for denorm in denorms)),
+        min_pk='' if min_pk is None else unicode(min_pk),
+        defaults={'max_pk': '' if max_pk is None else unicode(max_pk)},
+    )
+    return checkpoint
+
+
+def rebuild_model(model, denorms, chunk_size=None, min_pk=None, max_pk=None, checkpoint=None):
+    """
+    Recomputes the given denormalizations for every instance of ``model``,
+    or for those with a primary key between ``min_pk`` and ``max_pk``.
+    Instances up to the last primary key recorded in ``checkpoint`` are
+    skipped, and the checkpoint is updated along with every chunk.
+    """
+    if checkpoint is not None and checkpoint.done:
+        return
+    chunk_size = chunk_size or REBUILD_CHUNK_SIZE
+    queryset = model._base_manager.order_by('pk').values_list('pk', flat=True)
+    if min_pk is not None:
+        queryset = queryset.filter(pk__gte=min_pk)
+    if max_pk is not None:
+        queryset = queryset.filter(pk__lte=max_pk)
+    last_pk = None
+    if checkpoint is not None and checkpoint.last_pk:
+        last_pk = model._meta.pk.to_python(checkpoint.last_pk)
+    while True:
+        # Chunks are paginated by primary key instead of by offset, so
+        # every chunk is a cheap index range scan and only one chunk of
+        # instances is held in memory at a time.
+        def rebuild_chunk():
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(chunk[:chunk_size])
+            if pks:
+                flush_instances(model, denorms, dict.fromkeys(pks))
+            if checkpoint is not None:
+                if pks:
+                    checkpoint.last_pk = unicode(pks[-1])
+                checkpoint.done = len(pks) < chunk_size
+                checkpoint.save()
+            return pks
+        pks = run_in_transaction(rebuild_chunk)
+        if len(pks) < chunk_size:
+            break
+        last_pk = pks[-1]
+
+
+def get_pk_ranges(model, count):
+    """
+    Splits the primary keys of ``model`` into about ``count`` ranges of
+    equal width and returns them as ``(min_pk, max_pk)`` tuples.
+    Models without an integer primary key get a single ``(None, None)``
+    range covering all instances.
+    """
+    if not DirtyInstance.has_integer_key(model):
+        return [(None, None)]
+    bounds = model._base_manager.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+    if bounds['min_pk'] is None:
+        return []
+    width = (bounds['max_pk'] - bounds['min_pk']) // count + 1
+    return [
+        (min_pk, min(min_pk + width - 1, bounds['max_pk']))
+        for min_pk in range(bounds['min_pk'], bounds['max_pk'] + 1, width)
+    ]
+
+
+def rebuild_range(task):
+    """
+    Rebuilds one ``(app label, model name, field names, min_pk, max_pk,
+    chunk size)`` task in a worker process of ``rebuild_parallel()``.
+    Returns the task and the formatted traceback if it failed, None otherwise.
+    """
+    app_label, object_name, fieldnames, min_pk, max_pk, chunk_size = task
+    try:
+        model = get_model(app_label, object_name)
+        denorms = [
+            denorm for denorm in alldenorms
+            if denorm.model is model and denorm.fieldname in fieldnames
+        ]
+        checkpoint = get_checkpoint(model, denorms, min_pk, max_pk)
+        rebuild_model(model, denorms, chunk_size, min_pk, max_pk, checkpoint)
+    except Exception, e:
+        if isinstance(e, DatabaseError):
+            # The connection may be unusable now, the next task opens a new one.
+            connection.close()
+        return task, traceback.format_exc()
+    return task, None
+
+
+def rebuild_parallel(models, chunk_size, jobs, verbose=False):
+    """
+    Rebuilds the ``{model: denorms}`` in ``models`` with a pool of ``jobs``
+    processes, one primary key range at a time. Failed ranges are retried
+    up to ``REBUILD_RETRIES`` times before giving up.
+    The ranges are stored as checkpoints, a resumed rebuild continues
+    with the unfinished ones.
+    """
+    for model, denorms in models.items():
+        checkpoints = RebuildCheckpoint.objects.filter(
+            content_type=ContentType.objects.get_for_model(model),
+            field_names=','.join(sorted(denorm.fieldname for denorm in denorms)),
+        )
+        if checkpoints:
+            to_python = lambda value: model._meta.pk.to_python(value) if value else None
+            ranges = [
+                (to_python(checkpoint.min_pk), to_python(checkpoint.max_pk))
+                for checkpoint in checkpoints if not checkpoint.done
+            ]
+        else:
+            ranges = get_pk_ranges(model, jobs * REBUILD_RANGES_PER_JOB)
+            for min_pk, max_pk in ranges:
+                get_checkpoint(model, denorms, min_pk, max_pk)
+        tasks = [
+            (model._meta.app_label, model._meta.object_name, [denorm.fieldname for denorm in denorms], min_pk, max_pk, chunk_size)
+            for min_pk, max_pk in ranges
+        ]
+        # Forked workers must not share the connections of this process.
+        for cconnection in connections.all():
+            cconnection.close()
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for attempt in range(REBUILD_RETRIES + 1):
+                failed = []
+                for done, (task, error) in enumerate(pool.imap_unordered(rebuild_range, tasks)):
+                    if error:
+                        logger.warning('rebuilding %s pk range %s to %s failed:\n%s', model, task[3], task[4], error)
+                        failed.append(task)
+                    if verbose:
+                        print 'rebuilding', ', '.join(task[2]), 'in', model, '%s/%s' % (done + 1, len(tasks))
+                if not failed:
+                    break
+                tasks = failed
+            else:
+                raise RuntimeError('rebuilding %s failed for pk ranges %s' % (
+                    model, ', '.join('%s to %s' % (task[3], task[4]) for task in failed),
+                ))
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def audit(model_name=None, field_name=None, sample=None, chunk_size=None, delay=0, examples=10):
+    """
+    Compares the stored denormalized values with freshly computed ones
+    without writing anything, and returns a list of dictionaries with the
+    ``model``, the ``field``, the number of ``checked`` and ``drifted``
+    instances, the ``drift_rate`` and the primary keys of up to ``examples``
+    drifted instances.
+
+    With ``sample`` only about that many random instances of every model
+    are checked, otherwise all of them. Count and sum fields are checked
+    for all instances by a single query. To keep the load low, instances
+    are read ``chunk_size`` at a time, with a pause of ``delay`` seconds
+    after every chunk. Cache keys are random and can not be checked.
+    """
+    chunk_size = chunk_size or REBUILD_CHUNK_SIZE
+    report = []
+    for model, denorms in sorted(select_denorms(model_name, field_name).items(), key=lambda item: item[0]._meta.db_table):
+        results = []
+        checked = []
+        for denorm in sorted(denorms, key=lambda denorm: denorm.fieldname):
+            if isinstance(denorm, BaseCacheKeyDenorm):
+                continue
+            result = {
+                'model': unicode(model._meta),
+                'field': denorm.fieldname,
+                'checked': 0,
+                'drifted': 0,
+                'examples': [],
+            }
+            results.append(result)
+            if isinstance(denorm, AggregateDenorm) and not sample:
+                result['drifted'], result['examples'] = denorm.find_drift(examples)
+                result['checked'] = model._base_manager.count()
+                time.sleep(delay)
+            else:
+                checked.append((denorm, result))
+
+        if checked:
+            if sample:
+                pks = sample_pks(model, sample, chunk_size)
+                chunks = [pks[offset:offset + chunk_size] for offset in range(0, len(pks), chunk_size)]
+            else:
+                chunks = iter_pk_chunks(model, chunk_size)
+            for pks in chunks:
+                instances = model._base_manager.in_bulk(pks)
+                batch_values = dict(
+                    (denorm, denorm.get_values(instances.values()))
+                    for denorm, result in checked if denorm.batch_func is not None
+                )
+                for pk, instance in sorted(instances.items()):
+                    for denorm, result in checked:
+                        result['checked'] += 1
+                        if denorm.is_stale(instance, batch_values.get(denorm)):
+                            result['drifted'] += 1
+                            if len(result['examples']) < examples:
+                                result['examples'].append(pk)
+                time.sleep(delay)
+
+        for result in results:
+            result['drift_rate'] = float(result['drifted']) / result['checked'] if result['checked'] else 0
+        report.extend(results)
+    return report
+
+
+def iter_pk_chunks(model, chunk_size):
+    """
+    Yields the primary keys of all instances of ``model``, ``chunk_size``
+    at a time in ascending order.
+    """
+    queryset = model._base_manager.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(chunk[:chunk_size])
+        if pks:
+            yield pks
+        if len(pks) < chunk_size:
+            break
+        last_pk = pks[-1]
+
+
+def sample_pks(model, size, chunk_size):
+    """
+    Returns the primary keys of up to ``size`` random instances of ``model``
+    in ascending order.
+    Integer keys are drawn at random from the range of existing keys and
+    looked up ``chunk_size`` at a time, so no query has to sort the table.
+    """
+    if not DirtyInstance.has_integer_key(model):
+        return sorted(model._base_manager.order_by('?').values_list('pk', flat=True)[:size])
+    bounds = model._base_manager.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+    if bounds['min_pk'] is None:
+        return []
+    population = xrange(bounds['min_pk'], bounds['max_pk'] + 1)
+    pks = set()
+    # Deleted rows leave gaps in the keys, so some draws miss.
+    for attempt in range(10):
+        candidates = random.sample(population, min(2 * (size - len(pks)), len(population)))
+        for offset in range(0, len(candidates), chunk_size):
+            pks.update(model._base_manager.filter(pk__in=candidates[offset:offset + chunk_size]).values_list('pk', flat=True))
+        if len(pks) >= size or len(candidates) == len(population):
+            break
+    return sorted(random.sample(list(pks), min(size, len(pks))))
 
 
 def drop_triggers(using=None):
@@ -556,31 +1293,714 @@ def build_triggerset(using=None):
     triggerset = triggers.TriggerSet(using=using)
     for denorm in alldenorms:
         triggerset.append(denorm.get_triggers(using=using))
+    channel = getattr(settings, 'DENORM_NOTIFY_CHANNEL', None)
+    if channel:
+        triggerset.append(triggers.notify_trigger(channel, using=using))
     return triggerset
 
 
-def flush():
+def bulk_update(model, values, using=None):
+    """
+    Writes the given field values to many rows of ``model`` at once.
+
+    ``values`` maps primary keys to dictionaries of ``{field name: value}``.
+    Every changed column gets a single ``CASE`` expression, so one statement
+    updates a whole batch of rows with different values. Columns a row did
+    not change keep their current value through the ``ELSE`` branch.
+    """
+    if not values:
+        return
+
+    if using:
+        cconnection = connections[using]
+    else:
+        cconnection = connection
+    qn = cconnection.ops.quote_name
+    opts = model._meta
+    pk_column = qn(opts.pk.column)
+
+    field_names = set()
+    for fields in values.values():
+        field_names.update(fields)
+    fields = [opts.get_field(name) for name in sorted(field_names)]
+
+    # every row needs one parameter for the IN clause and two for each
+    # column it may appear in.
+    batch_size = max(cconnection.ops.bulk_batch_size([None] * (1 + 2 * len(fields)), values), 1)
+    pks = list(values)
+    cursor = cconnection.cursor()
+    for offset in range(0, len(pks), batch_size):
+        batch = pks[offset:offset + batch_size]
+        assignments = []
+        params = []
+        for field in fields:
+            column = qn(field.column)
+            cases = []
+            for pk in batch:
+                if field.name in values[pk]:
+                    cases.append('WHEN %s THEN %s')
+                    params.append(opts.pk.get_db_prep_value(pk, connection=cconnection))
+                    params.append(field.get_db_prep_save(values[pk][field.name], connection=cconnection))
+            if cases:
+                assignments.append('%s = CASE %s %s ELSE %s END' % (column, pk_column, ' '.join(cases), column))
+        params.extend([opts.pk.get_db_prep_value(pk, connection=cconnection) for pk in batch])
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(opts.db_table),
+            ', '.join(assignments),
+            pk_column,
+            ', '.join(['%s'] * len(batch)),
+        ), params)
+
+
+def get_callback_denorms():
+    """
+    Returns a dictionary mapping every model to the list of its callback
+    based denormalizations, the ones ``flush()`` has to recompute.
+    """
+    global alldenorms
+    denorms = {}
+    for denorm in alldenorms:
+        if isinstance(denorm, BaseCallbackDenorm):
+            denorms.setdefault(denorm.model, []).append(denorm)
+    return denorms
+
+
+def flush_instances(model, denorms, dirty):
+    """
+    Recomputes denormalizations of many instances of ``model`` and writes
+    the changed values back with a single bulk update.
+
+    ``dirty`` maps primary keys to the set of field names that need to be
+    recomputed, or to None if all of the given ``denorms`` do.
+    """
+    timings = dict((denorm, 0) for denorm in denorms)
+    written = 0
+    last_id = DirtyInstance.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+    # Expressions are computed by the database, without loading instances.
+    for denorm in [denorm for denorm in denorms if denorm.expression is not None]:
+        started = time.time()
+        written += denorm.update_expression([
+            pk for pk, field_names in dirty.items()
+            if field_names is None or denorm.fieldname in field_names
+        ])
+        timings[denorm] += time.time() - started
+    denorms = [denorm for denorm in denorms if denorm.expression is None]
+    instances = model._base_manager.in_bulk(dirty.keys()) if denorms else {}
+
+    def get_field_names(pk):
+        # in_bulk() returns the primary keys in their python type,
+        # the markers hold non-integer keys as strings.
+        return dirty.get(pk, dirty.get(unicode(pk)))
+
+    values = {}
+
+    # Batch callbacks compute the values of all instances at once.
+    batch_values = {}
+    for denorm in denorms:
+        if denorm.batch_func is None:
+            continue
+        batch = [
+            instance for pk, instance in instances.items()
+            if get_field_names(pk) is None or denorm.fieldname in get_field_names(pk)
+        ]
+        if batch:
+            started = time.time()
+            batch_values[denorm] = denorm.get_values(batch)
+            timings[denorm] += time.time() - started
+
+    for pk, instance in instances.items():
+        field_names = get_field_names(pk)
+        changed = {}
+        for denorm in denorms:
+            if field_names is not None and denorm.fieldname not in field_names:
+                continue
+            started = time.time()
+            _fields = denorm.update(instance, batch_values.get(denorm))
+            timings[denorm] += time.time() - started
+            if _fields:
+                changed.update(_fields)
+        if changed:
+            values[pk] = dict(
+                (name, getattr(instance, model._meta.get_field(name).attname))
+                for name in changed
+            )
+    bulk_update(model, values)
+    if written or values:
+        drop_own_markers(model, dirty.keys(), last_id)
+
+    sink = metrics.get_sink()
+    for denorm, seconds in timings.items():
+        sink.increment('denorm_callback_seconds_total', seconds, field='%s.%s' % (model._meta, denorm.fieldname))
+    sink.increment('denorm_rows_written_total', written + len(values), model=unicode(model._meta))
+
+
+def drop_own_markers(model, pks, last_id):
+    """
+    Deletes the markers the update trigger of ``model`` created for the
+    rows with the given primary keys after the marker ``last_id``.
+
+    Writing the recomputed values fires that trigger, which marks the
+    rows dirty for all fields again, although only denormalized columns
+    changed. Markers of other connections are left alone.
+    """
+    qn = connection.ops.quote_name
+    markers = DirtyInstance.objects.filter(
+        content_type=ContentType.objects.get_for_model(model),
+        field_name='',
+        id__gt=last_id,
+    ).extra(where=['%s = %s' % (qn('tag'), triggers.ConnectionTag().sql())])
+    if DirtyInstance.has_integer_key(model):
+        markers = markers.filter(object_id__in=list(pks))
+    else:
+        markers = markers.filter(object_key__in=[unicode(pk) for pk in pks])
+    markers.delete()
+
+
+def get_flush_order(denorms):
+    """
+    Returns the models in ``denorms`` in the order ``flush()`` should process them.
+
+    Recomputing an instance of a model can mark instances of the models
+    depending on it as dirty, so those need to come later. Models that
+    depend on each other (including models depending on themselves) form a
+    cycle and can not be ordered, they are returned together in one group.
+    The result is a list of such groups in topological order.
+    """
+    graph = dict((model, set()) for model in denorms)
+    for model, model_denorms in denorms.items():
+        for denorm in model_denorms:
+            for dependency in denorm.depend:
+                other_model = getattr(dependency, 'other_model', None)
+                if other_model in graph:
+                    graph[other_model].add(model)
+
+    # Tarjan's algorithm finds the strongly connected components
+    # in reverse topological order.
+    index = {}
+    lowlink = {}
+    stack = []
+    groups = []
+
+    def visit(model):
+        index[model] = lowlink[model] = len(index)
+        stack.append(model)
+        for other_model in graph[model]:
+            if other_model not in index:
+                visit(other_model)
+                lowlink[model] = min(lowlink[model], lowlink[other_model])
+            elif other_model in stack:
+                lowlink[model] = min(lowlink[model], index[other_model])
+        if lowlink[model] == index[model]:
+            group = []
+            while True:
+                other_model = stack.pop()
+                group.append(other_model)
+                if other_model is model:
+                    break
+            groups.append(group)
+
+    for model in sorted(graph, key=lambda m: m._meta.db_table):
+        if model not in index:
+            visit(model)
+    groups.reverse()
+    return groups
+
+
+def get_flush_groups(denorms):
+    """
+    Returns the result of ``get_flush_order()`` with every model
+    replaced by a ``(content type id, model)`` pair.
+    """
+    return [
+        [(ContentType.objects.get_for_model(model).pk, model) for model in group]
+        for group in get_flush_order(denorms)
+    ]
+
+
+def marker_conditions(shard=None, tag=None):
+    """
+    Returns SQL conditions and their parameters restricting dirty markers
+    to a ``(column, index, count)`` shard and to markers with the given
+    connection ``tag``.
+    """
+    qn = connection.ops.quote_name
+    conditions, params = [], []
+    if shard is not None:
+        column, index, count = shard
+        conditions.append('%s %%%% %%s = %%s' % qn(column))
+        params.extend([count, index])
+    if tag is not None:
+        conditions.append('%s = %%s' % qn('tag'))
+        params.append(tag)
+    return conditions, params
+
+
+def claim_markers(content_type_id, limit, min_id, max_id, skip_locked=False, shard=None):
+    """
+    Returns ``(id, object_id, object_key, field_name)`` tuples of the oldest ``limit`` dirty markers
+    of the given content type with an id greater than ``min_id`` and up to ``max_id``.
+    With ``skip_locked`` the markers stay locked until the current transaction
+    ends and markers locked by a concurrent ``flush()`` are skipped.
+    """
+    qn = connection.ops.quote_name
+    conditions, params = marker_conditions(shard)
+    sql = 'SELECT %(id)s, %(object_id)s, %(object_key)s, %(field_name)s FROM %(table)s WHERE %(where)s ORDER BY %(id)s LIMIT %%s' % {
+        'id': qn('id'),
+        'object_id': qn('object_id'),
+        'object_key': qn('object_key'),
+        'field_name': qn('field_name'),
+        'table': qn(DirtyInstance._meta.db_table),
+        'where': ' AND '.join(['%s = %%s' % qn('content_type_id'), '%s > %%s' % qn('id'), '%s <= %%s' % qn('id')] + conditions),
+    }
+    if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+    cursor = connection.cursor()
+    cursor.execute(sql, [content_type_id, min_id, max_id] + params + [limit])
+    return cursor.fetchall()
+
+
+def flush_markers(model, denorms, markers):
+    """
+    Deletes a chunk of ``(id, object_id, object_key, field_name)`` dirty
+    markers and recomputes the instances they reference.
+    The markers are deleted first, so instances marked dirty again while
+    they are recomputed get a new marker instead of colliding with the
+    claimed one.
+    """
+    DirtyInstance.objects.filter(pk__in=[marker[0] for marker in markers]).delete()
+    if model is not None:
+        metrics.get_sink().increment('denorm_markers_processed_total', len(markers), content_type=unicode(model._meta))
+    dirty = {}
+    for marker_id, object_id, object_key, field_name in markers:
+        pk = object_key or object_id
+        if not field_name:
+            dirty[pk] = None
+        elif dirty.get(pk, ()) is not None:
+            dirty.setdefault(pk, set()).add(field_name)
+    if denorms and dirty:
+        flush_instances(model, denorms, dirty)
+
+
+def in_transaction():
+    """
+    Returns whether a transaction is open on the default connection.
+    """
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block
+    return connection.is_managed()
+
+
+def run_in_transaction(func):
+    """
+    Calls ``func`` in a transaction of its own and returns its result.
+    Transactions aborted by a deadlock or a serialization failure are
+    retried up to ``FLUSH_RETRIES`` times, after a random delay that
+    doubles with every attempt so competing processes drift apart.
+    Inside an outer transaction ``func`` runs in a savepoint and errors
+    are re-raised: a deadlock has already rolled back the outer
+    transaction, so only its owner can retry.
+    """
+    nested = in_transaction()
+    for attempt in range(FLUSH_RETRIES + 1):
+        try:
+            with atomic():
+                return func()
+        except DatabaseError, e:
+            if nested or attempt == FLUSH_RETRIES or not triggers.is_retryable(e):
+                raise
+            delay = random.uniform(0, FLUSH_RETRY_DELAY * 2 ** attempt)
+            logger.warning('%s, retrying in %.2f seconds', e, delay)
+            time.sleep(delay)
+
+
+def flush_content_types(content_types, denorms, skip_locked=False, chunk_size=None, shard=None):
+    """
+    Processes all dirty markers of the given ``(content type id, model)``
+    pairs that exist when this function is called, ``chunk_size`` markers
+    at a time.
+    Returns the number of processed markers.
+    """
+    chunk_size = chunk_size or FLUSH_CHUNK_SIZE
+    max_id = DirtyInstance.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return 0
+
+    processed = 0
+    for content_type_id, model in content_types:
+        # Chunks are paginated by marker id, so every chunk is a cheap
+        # index range scan no matter how many markers are waiting.
+        last_id = 0
+        while True:
+            def flush_chunk():
+                markers = claim_markers(content_type_id, chunk_size, last_id, max_id, skip_locked, shard)
+                if markers:
+                    flush_markers(model, denorms.get(model), markers)
+                return markers
+            markers = run_in_transaction(flush_chunk)
+            if not markers:
+                break
+            last_id = markers[-1][0]
+            processed += len(markers)
+    return processed
+
+
+def claim_oldest_markers(limit, min_id, skip_locked=False, tag=None, shard=None):
+    """
+    Returns ``(id, content_type_id, object_id, object_key, field_name)`` tuples
+    of the oldest ``limit`` dirty markers with an id greater than ``min_id``,
+    regardless of their content type.
+    If ``tag`` is given only markers created by the connection with that
+    tag are returned.
+    """
+    qn = connection.ops.quote_name
+    conditions, params = marker_conditions(shard, tag)
+    sql = 'SELECT %(id)s, %(content_type_id)s, %(object_id)s, %(object_key)s, %(field_name)s FROM %(table)s WHERE %(where)s ORDER BY %(id)s LIMIT %%s' % {
+        'id': qn('id'),
+        'content_type_id': qn('content_type_id'),
+        'object_id': qn('object_id'),
+        'object_key': qn('object_key'),
+        'field_name': qn('field_name'),
+        'table': qn(DirtyInstance._meta.db_table),
+        'where': ' AND '.join(['%s > %%s' % qn('id')] + conditions),
+    }
+    if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+    cursor = connection.cursor()
+    cursor.execute(sql, [min_id] + params + [limit])
+    return cursor.fetchall()
+
+
+def flush_oldest(denorms, groups, max_items=None, max_seconds=None, skip_locked=False, chunk_size=None, tag=None, shard=None):
+    """
+    Processes the oldest dirty markers in chunks until either ``max_items``
+    markers were processed, ``max_seconds`` have passed or no markers are
+    left. The markers of every chunk are handled in the order of ``groups``.
+    A chunk that was started is always finished, so ``max_seconds`` may be
+    exceeded by the time it takes to process one chunk.
+    With ``tag`` only markers created by that connection are processed.
+    Returns the number of processed markers.
+    """
+    chunk_size = chunk_size or FLUSH_CHUNK_SIZE
+    order = dict(
+        (content_type_id, position)
+        for position, (content_type_id, model) in enumerate(content_type for group in groups for content_type in group)
+    )
+    started = time.time()
+    processed = 0
+    last_id = 0
+    while max_items is None or processed < max_items:
+        if max_seconds is not None and time.time() - started >= max_seconds:
+            break
+        limit = chunk_size if max_items is None else min(chunk_size, max_items - processed)
+
+        def flush_chunk():
+            markers = claim_oldest_markers(limit, last_id, skip_locked, tag, shard)
+            by_content_type = {}
+            for marker in markers:
+                by_content_type.setdefault(marker[1], []).append(marker[:1] + marker[2:])
+            for content_type_id in sorted(by_content_type, key=lambda ct: (order.get(ct, len(order)), ct)):
+                model = ContentType.objects.get_for_id(content_type_id).model_class()
+                flush_markers(model, denorms.get(model), by_content_type[content_type_id])
+            return markers
+        markers = run_in_transaction(flush_chunk)
+        if not markers:
+            break
+        last_id = markers[-1][0]
+        processed += len(markers)
+    return processed
+
+
+class DeltasTaken(Exception):
+    """
+    Raised when deltas were compacted by a concurrent ``compact()``.
+    """
+
+
+def claim_deltas(limit, skip_locked=False):
+    """
+    Returns ``(id, content_type_id, object_id, field_name, delta)`` tuples
+    of the oldest ``limit`` pending deltas.
+    """
+    qn = connection.ops.quote_name
+    sql = 'SELECT %(id)s, %(content_type_id)s, %(object_id)s, %(field_name)s, %(delta)s FROM %(table)s ORDER BY %(id)s LIMIT %%s' % {
+        'id': qn('id'),
+        'content_type_id': qn('content_type_id'),
+        'object_id': qn('object_id'),
+        'field_name': qn('field_name'),
+        'delta': qn('delta'),
+        'table': qn(AggregateDelta._meta.db_table),
+    }
+    if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+    cursor = connection.cursor()
+    cursor.execute(sql, [limit])
+    return cursor.fetchall()
+
+
+def apply_deltas(deltas):
+    """
+    Deletes a chunk of ``(id, content_type_id, object_id, field_name, delta)``
+    pending deltas and adds them to the stored values, with one statement
+    per field and batch of instances.
+    Raises ``DeltasTaken`` if some of them were already deleted.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(AggregateDelta._meta.db_table), qn('id'), ', '.join(['%s'] * len(deltas)),
+    ), [delta[0] for delta in deltas])
+    if cursor.rowcount != len(deltas):
+        raise DeltasTaken()
+
+    totals = {}
+    for delta_id, content_type_id, object_id, field_name, delta in deltas:
+        values = totals.setdefault((content_type_id, field_name), {})
+        values[object_id] = values.get(object_id, 0) + delta
+
+    for (content_type_id, field_name), values in sorted(totals.items()):
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        opts = model._meta
+        column = qn(opts.get_field(field_name).column)
+        # Sorted, so concurrent compactions lock the rows in the same order.
+        items = sorted((object_id, delta) for object_id, delta in values.items() if delta)
+        batch_size = max(connection.ops.bulk_batch_size([None] * 3, items), 1)
+        for offset in range(0, len(items), batch_size):
+            batch = items[offset:offset + batch_size]
+            cursor.execute('UPDATE %(table)s SET %(column)s = %(column)s + CASE %(pk)s %(cases)s END WHERE %(pk)s IN (%(pks)s)' % {
+                'table': qn(opts.db_table),
+                'column': column,
+                'pk': qn(opts.pk.column),
+                'cases': ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                'pks': ', '.join(['%s'] * len(batch)),
+            }, [value for item in batch for value in item] + [object_id for object_id, delta in batch])
+        metrics.get_sink().increment('denorm_rows_written_total', len(items), model=unicode(opts))
+
+
+def compact(chunk_size=None, max_items=None, max_seconds=None, skip_locked=False):
+    """
+    Adds the pending deltas of deferred count and sum fields to their
+    stored values and deletes them, ``chunk_size`` deltas per transaction.
+    ``flush()`` calls this before processing dirty markers.
+    ``max_items`` and ``max_seconds`` limit the work done like they do
+    for ``flush_oldest()``.
+
+    Chunks compacted by a concurrent call are skipped. With
+    ``skip_locked`` they are not even attempted, see ``flush()``.
+    Returns the number of compacted deltas.
+    """
+    chunk_size = chunk_size or FLUSH_CHUNK_SIZE
+    started = time.time()
+    processed = 0
+    while max_items is None or processed < max_items:
+        if max_seconds is not None and time.time() - started >= max_seconds:
+            break
+        limit = chunk_size if max_items is None else min(chunk_size, max_items - processed)
+
+        def compact_chunk():
+            deltas = claim_deltas(limit, skip_locked)
+            if deltas:
+                apply_deltas(deltas)
+            return deltas
+        try:
+            deltas = run_in_transaction(compact_chunk)
+        except DeltasTaken:
+            continue
+        if not deltas:
+            break
+        processed += len(deltas)
+    metrics.get_sink().increment('denorm_deltas_compacted_total', processed)
+    return processed
+
+
+def exact_value(instance, field_name):
+    """
+    Returns the current value of the count or sum field ``field_name`` of
+    ``instance`` as stored in the database, including the pending deltas
+    of deferred fields that were not compacted yet.
+    """
+    denorm = instance._meta.get_field(field_name).denorm
+    using = router.db_for_read(instance.__class__, instance=instance)
+    cconnection = connections[using]
+    qn = cconnection.ops.quote_name
+    pending, params = denorm.get_pending_sql(using)
+    opts = instance._meta
+    cursor = cconnection.cursor()
+    cursor.execute('SELECT %(table)s.%(column)s + %(pending)s FROM %(table)s WHERE %(table)s.%(pk)s = %%s' % {
+        'table': qn(opts.db_table),
+        'column': qn(opts.get_field(field_name).column),
+        'pending': pending,
+        'pk': qn(opts.pk.column),
+    }, list(params) + [instance.pk])
+    row = cursor.fetchone()
+    if row is None:
+        raise instance.DoesNotExist()
+    return row[0]
+
+
+def flush(skip_locked=False, chunk_size=None, max_items=None, max_seconds=None, shard=None, shard_by='object_id'):
     """
     Updates all model instances marked as dirty by the DirtyInstance
     model.
     After this method finishes the DirtyInstance table is empty and
     all denormalized fields have consistent data.
-    """
 
+    Models are processed in the order of their dependencies, so changes
+    usually propagate through a whole chain of denormalizations within a
+    single pass. Models depending on each other are revisited up to
+    ``FLUSH_MAX_ITERATIONS`` times per pass.
+    After ``FLUSH_MAX_PASSES`` passes the remaining markers are left for
+    the next call and a warning is logged.
+
+    Dirty markers are processed in chunks of ``chunk_size`` (defaults to
+    ``FLUSH_CHUNK_SIZE``), each one in its own transaction, so memory use
+    does not grow with the number of dirty markers.
+    With ``skip_locked`` the chunks are claimed with
+    ``SELECT ... FOR UPDATE SKIP LOCKED``, so any number of threads or
+    processes can flush at the same time without doing the same work twice.
+    This requires PostgreSQL 9.5 or MySQL 8.0.1 and newer.
+
+    ``max_items`` and ``max_seconds`` limit the amount of work done by this
+    call. The oldest dirty markers are processed first and everything
+    beyond the budget is left for the next call, so the table may not be
+    empty afterwards.
+
+    ``shard`` is an ``(index, count)`` pair that limits this call to the
+    markers whose ``shard_by`` column (``object_id`` or ``content_type_id``)
+    modulo ``count`` equals ``index``. ``count`` processes with different
+    indexes share the work without touching the same markers. Markers of
+    models with non-integer primary keys all belong to the first shard
+    when sharding by ``object_id``.
+
+    Pending deltas of deferred count and sum fields are compacted first,
+    see ``compact()``. They count against ``max_items`` and ``max_seconds``
+    just like dirty markers.
+
+    Returns the number of processed dirty markers and compacted deltas.
+    """
+    if skip_locked and not triggers.supports_skip_locked(connection):
+        raise NotImplementedError('SKIP LOCKED is not supported by this database')
+    if shard_by not in ('object_id', 'content_type_id'):
+        raise ValueError('Dirty markers can only be sharded by object_id or content_type_id')
+    if shard is not None:
+        shard = (shard_by,) + tuple(shard)
+
+    # Pending deltas are not sharded, the first shard compacts them all.
+    # They count against the budget of this call.
+    processed = 0
+    if (shard is None or shard[1] == 0) and any(getattr(denorm, 'deferred', False) for denorm in alldenorms):
+        started = time.time()
+        processed = compact(chunk_size, max_items, max_seconds, skip_locked)
+        if max_items is not None:
+            max_items = max(max_items - processed, 0)
+        if max_seconds is not None:
+            max_seconds = max(max_seconds - (time.time() - started), 0)
+
+    denorms = get_callback_denorms()
+    groups = get_flush_groups(denorms)
+    if max_items is not None or max_seconds is not None:
+        processed += flush_oldest(denorms, groups, max_items, max_seconds, skip_locked, chunk_size, shard=shard)
+        publish_metrics(0)
+        return processed
+
+    ordered_content_type_ids = set(content_type_id for group in groups for content_type_id, model in group)
+
+    passes = 0
     # Loop until break.
     # We may need multiple passes, because an update on one instance
     # may cause an other instance to be marked dirty (dependency chains)
     while True:
-        # Get all dirty markers
-        qs = DirtyInstance.objects.all()
+        content_type_ids = set(DirtyInstance.objects.values_list('content_type_id', flat=True).distinct())
 
         # DirtyInstance table is empty -> all data is consistent -> we're done
-        if not qs:
+        if not content_type_ids:
+            break
+
+        if passes == FLUSH_MAX_PASSES:
+            logger.warning('flush() gave up after %s passes, %s dirty markers of %s are left',
+                passes, DirtyInstance.objects.count(),
+                ', '.join(sorted(unicode(ContentType.objects.get_for_id(content_type_id)) for content_type_id in content_type_ids)))
+            break
+
+        # Markers of models without callback denormalizations are only deleted.
+        pass_groups = groups + [
+            [(content_type_id, ContentType.objects.get_for_id(content_type_id).model_class())]
+            for content_type_id in sorted(content_type_ids - ordered_content_type_ids)
+        ]
+
+        passes += 1
+        claimed = 0
+        for group in pass_groups:
+            for iteration in range(FLUSH_MAX_ITERATIONS):
+                count = flush_content_types(group, denorms, skip_locked, chunk_size, shard)
+                if not count:
+                    break
+                claimed += count
+        processed += claimed
+
+        # With skip_locked or a shard the remaining markers are in the
+        # hands of concurrent flushes which will take care of them.
+        if not claimed:
             break
 
-        # Call save() on all dirty instances, causing the self_save_handler()
-        # getting called by the pre_save signal.
-        for dirty_instance in qs.iterator():
-            if dirty_instance.content_object:
-                dirty_instance.content_object.save()
-            dirty_instance.delete()
+    logger.debug('flush() finished after %s passes', passes)
+    publish_metrics(passes)
+    return processed
+
+
+def oldest_marker_age():
+    """
+    Returns the age of the oldest dirty marker in seconds, 0 if there is none.
+    """
+    qn = connection.ops.quote_name
+    table = qn(DirtyInstance._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %(age)s FROM %(table)s WHERE %(id)s = (SELECT MIN(%(id)s) FROM %(table)s)' % {
+        'age': triggers.age_sql(qn('created')),
+        'table': table,
+        'id': qn('id'),
+    })
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return 0
+    return float(row[0])
+
+
+def publish_metrics(passes):
+    """
+    Reports the metrics describing the whole of a ``flush()`` call.
+    """
+    sink = metrics.get_sink()
+    sink.increment('denorm_flush_passes_total', passes)
+    if sink.enabled:
+        sink.gauge('denorm_oldest_marker_age_seconds', oldest_marker_age())
+    sink.publish()
+
+
+def get_connection_tag():
+    """
+    Returns the tag the triggers put on dirty markers created through
+    the current database connection.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s' % triggers.ConnectionTag().sql())
+    return cursor.fetchone()[0]
+
+
+def flush_current_transaction():
+    """
+    Updates only the model instances marked as dirty by writes of the
+    current database connection, including instances those updates mark
+    dirty in turn. Dirty markers created by other connections are left
+    alone.
+
+    The instances are updated right away. Inside a transaction the
+    updates become part of it, so call this just before committing or
+    after the commit while the connection is still open, as
+    ``DenormMiddleware`` does with ``DENORM_MIDDLEWARE_CURRENT_TRANSACTION``.
+    SQLite can not tell connections apart, so all markers are processed there.
+    """
+    denorms = get_callback_denorms()
+    flush_oldest(denorms, get_flush_groups(denorms), tag=get_connection_tag())
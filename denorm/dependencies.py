@@ -8,6 +8,28 @@ from django.contrib.contenttypes.models import ContentType
 from denorm.db import triggers
 
 
+def dirty_instance_action(model, content_type, pk, field_name='', table=None, **where):
+    """
+    Returns a trigger action that marks the instance of ``model`` with the
+    primary key ``pk`` (an SQL expression) as dirty.
+    If ``table`` is given, the primary keys are selected from ``table``
+    with the conditions in ``where`` instead.
+    An empty ``field_name`` marks all denormalized fields of the instance.
+    """
+    if DirtyInstance.has_integer_key(model):
+        object_id, object_key, object_key_hash = pk, triggers.StringLiteral(''), triggers.StringLiteral('')
+    else:
+        object_id, object_key, object_key_hash = '0', pk, triggers.key_hash_sql(pk)
+    values = (content_type, object_id, object_key, object_key_hash, triggers.StringLiteral(field_name), triggers.ConnectionTag(), 'CURRENT_TIMESTAMP')
+    if table is not None:
+        values = triggers.TriggerNestedSelect(table, values, **where)
+    return triggers.TriggerActionInsert(
+        model=DirtyInstance,
+        columns=("content_type_id", "object_id", "object_key", "object_key_hash", "field_name", "tag", "created"),
+        values=values,
+    )
+
+
 class DenormDependency(object):
 
     """
@@ -276,25 +298,19 @@ class CallbackDependOnRelated(DependOnRelated):
             # may be related to one instance of ``other_model``
             # so we need to do a nested select query in the trigger
             # to find them all.
-            action_new = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=triggers.TriggerNestedSelect(
-                    self.this_model._meta.pk.model._meta.db_table,
-                    (content_type,
-                        self.this_model._meta.pk.get_attname_column()[1]),
-                    **{self.field.get_attname_column()[1]: "NEW.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
-                )
+            action_new = dirty_instance_action(
+                self.this_model, content_type,
+                self.this_model._meta.pk.get_attname_column()[1],
+                self.fieldname,
+                self.this_model._meta.pk.model._meta.db_table,
+                **{self.field.get_attname_column()[1]: "NEW.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
             )
-            action_old = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=triggers.TriggerNestedSelect(
-                    self.this_model._meta.pk.model._meta.db_table,
-                    (content_type,
-                        self.this_model._meta.pk.get_attname_column()[1]),
-                    **{self.field.get_attname_column()[1]: "OLD.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
-                )
+            action_old = dirty_instance_action(
+                self.this_model, content_type,
+                self.this_model._meta.pk.get_attname_column()[1],
+                self.fieldname,
+                self.this_model._meta.pk.model._meta.db_table,
+                **{self.field.get_attname_column()[1]: "OLD.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
             )
             return [
                 triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip),
@@ -308,25 +324,22 @@ class CallbackDependOnRelated(DependOnRelated):
             # If the ``other_model`` instance changes the value its ForeignKey
             # pointing to ``this_model`` both the old and the new related instance
             # are affected, otherwise only the one it is pointing to is affected.
-            action_new = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=triggers.TriggerNestedSelect(
-                    self.field.model._meta.db_table,
-                    (content_type,
-                        self.field.get_attname_column()[1]),
-                    **{self.field.model._meta.pk.get_attname_column()[1]: "NEW.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
-                )
+            # The related instances are looked up by the ForeignKey values
+            # of the NEW and OLD rows, the row itself has already changed or
+            # is gone when the trigger runs. A NULL ForeignKey matches nothing.
+            action_new = dirty_instance_action(
+                self.this_model, content_type,
+                self.this_model._meta.pk.get_attname_column()[1],
+                self.fieldname,
+                self.this_model._meta.pk.model._meta.db_table,
+                **{self.this_model._meta.pk.get_attname_column()[1]: "NEW.%s" % qn(self.field.get_attname_column()[1])}
             )
-            action_old = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=triggers.TriggerNestedSelect(
-                    self.field.model._meta.db_table,
-                    (content_type,
-                        self.field.get_attname_column()[1]),
-                    **{self.field.model._meta.pk.get_attname_column()[1]: "OLD.%s" % qn(self.other_model._meta.pk.get_attname_column()[1])}
-                )
+            action_old = dirty_instance_action(
+                self.this_model, content_type,
+                self.this_model._meta.pk.get_attname_column()[1],
+                self.fieldname,
+                self.this_model._meta.pk.model._meta.db_table,
+                **{self.this_model._meta.pk.get_attname_column()[1]: "OLD.%s" % qn(self.field.get_attname_column()[1])}
             )
             return [
                 triggers.Trigger(self.other_model, "after", "update", [action_new, action_old], content_type, using, self.skip),
@@ -355,21 +368,11 @@ class CallbackDependOnRelated(DependOnRelated):
             # The first part of a M2M dependency is exactly like a backward
             # ForeignKey dependency. ``this_model`` is backward FK related
             # to the intermediate table.
-            action_m2m_new = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=(
-                    content_type,
-                    "NEW.%s" % column_name,
-                )
+            action_m2m_new = dirty_instance_action(
+                self.this_model, content_type, "NEW.%s" % column_name, self.fieldname,
             )
-            action_m2m_old = triggers.TriggerActionInsert(
-                model=DirtyInstance,
-                columns=("content_type_id", "object_id"),
-                values=(
-                    content_type,
-                    "OLD.%s" % column_name,
-                )
+            action_m2m_old = dirty_instance_action(
+                self.this_model, content_type, "OLD.%s" % column_name, self.fieldname,
             )
 
             trigger_list = [
@@ -387,14 +390,10 @@ class CallbackDependOnRelated(DependOnRelated):
                 #
                 # Generic relations are excluded because they have the
                 # same m2m_table and model table.
-                action_new = triggers.TriggerActionInsert(
-                    model=DirtyInstance,
-                    columns=("content_type_id", "object_id"),
-                    values=triggers.TriggerNestedSelect(
-                        self.field.m2m_db_table(),
-                        (content_type, column_name),
-                        **{reverse_column_name: 'NEW.%s' % qn(self.other_model._meta.pk.get_attname_column()[1])}
-                    )
+                action_new = dirty_instance_action(
+                    self.this_model, content_type, column_name, self.fieldname,
+                    self.field.m2m_db_table(),
+                    **{reverse_column_name: 'NEW.%s' % qn(self.other_model._meta.pk.get_attname_column()[1])}
                 )
                 trigger_list.append(triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip))
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.db import models
 from denorm import denorms
+from denorm.dependencies import depend_on_related
 from django.conf import settings
 import django.db.models
 
@@ -20,10 +21,18 @@ def denormalized(DBField, *args, **kwargs):
         Note that you have to use the field class and not an instance
         of it.
 
+    batch
+        If True, the callable receives a list of instances instead of a single
+        one and returns a dictionary mapping their primary keys to the values,
+        so a single query can compute the values of many instances.
+        ``flush()`` and ``rebuildall()`` call it once per chunk of instances,
+        instances missing from the dictionary get the default of the field.
+
     \*args, \*\*kwargs:
         Those will be passed unaltered into the constructor of ``DBField``
         once it gets actually created.
     """
+    batch = kwargs.pop('batch', False)
 
     class DenormDBField(DBField):
 
@@ -38,12 +47,22 @@ def denormalized(DBField, *args, **kwargs):
             DBField.__init__(self, *args, **kwargs)
 
         def contribute_to_class(self, cls, name, *args, **kwargs):
-            if hasattr(settings, 'DENORM_BULK_UNSAFE_TRIGGERS') and settings.DENORM_BULK_UNSAFE_TRIGGERS:
+            if getattr(self.func, 'immediate', False):
+                self.denorm = denorms.TriggerExpressionDenorm(skip=self.skip)
+            elif hasattr(settings, 'DENORM_BULK_UNSAFE_TRIGGERS') and settings.DENORM_BULK_UNSAFE_TRIGGERS:
                 self.denorm = denorms.BaseCallbackDenorm(skip=self.skip)
             else:
                 self.denorm = denorms.CallbackDenorm(skip=self.skip)
-            self.denorm.func = self.func
+            if batch:
+                # Single instances, e.g. in pre_save(), are computed as a batch of one.
+                self.denorm.batch_func = self.func
+                self.denorm.func = lambda instance: self.denorm.get_values([instance])[instance.pk]
+            else:
+                self.denorm.func = self.func
+            self.denorm.expression = getattr(self.func, 'expression', None)
             self.denorm.depend = [dcls(*dargs, **dkwargs) for (dcls, dargs, dkwargs) in getattr(self.func, 'depend', [])]
+            for dependency in self.denorm.depend:
+                dependency.fieldname = name
             self.denorm.model = cls
             self.denorm.fieldname = name
             self.field_args = (args, kwargs)
@@ -82,6 +101,80 @@ def denormalized(DBField, *args, **kwargs):
     return deco
 
 
+def denormalized_expression(DBField, queryset, outer_ref, *args, **kwargs):
+    """
+    Creates a model field whose value is computed by the database.
+
+    ``flush()`` and ``rebuildall()`` update the dirty instances with one
+    ``UPDATE ... SET field = (SELECT ...)`` statement per chunk, without
+    loading them. The value gets updated whenever a row of the queryset's
+    model changes, just like with ``depend_on_related``.
+    With ``immediate=True`` the triggers update the value themselves.
+
+    **Arguments:**
+
+    DBField (required)
+        The type of field you want to use to save the data.
+
+    queryset (required)
+        A callable returning a queryset that selects a single column with
+        ``values_list()``. The value of an instance is the first row of the
+        queryset that is related to it. For example::
+
+            >>> latest_post_title = denormalized_expression(
+            ...     models.CharField, lambda: Post.objects.order_by('-created').values_list('title'),
+            ...     'Post.forum', max_length=255, default='')
+
+        The callable is only called once all models are loaded. A queryset
+        can be passed instead, but building it within a class body looks up
+        fields while the models are still being loaded.
+
+    outer_ref (required)
+        The name of the ForeignKey of the queryset's model pointing
+        to the model the field is declared in. With a callable it is
+        prefixed with the name of the queryset's model, which may also
+        be given as ``"app_label.Model"``.
+
+    immediate
+        If True, the triggers on the queryset's model compute the value
+        right away, like they do for ``CountField``. Changes are visible
+        as soon as they are committed, without waiting for ``flush()``,
+        at the cost of running the query on every write.
+        SQLite can not take parameters in trigger definitions, so querysets
+        with filters raise ``NotImplementedError`` there. A queryset is
+        checked right away, a callable as soon as it is first called.
+        The selected value must have the type of the field, e.g. select
+        ``TRUE`` rather than ``1`` for a ``BooleanField``.
+
+    \*args, \*\*kwargs:
+        Those will be passed unaltered into the constructor of ``DBField``.
+        If the field has a default, instances without related rows get it.
+    """
+    immediate = kwargs.pop('immediate', False)
+    if callable(queryset):
+        other_model, outer_ref = outer_ref.rsplit('.', 1)
+    else:
+        other_model = queryset.model
+        if immediate:
+            denorms.TriggerExpressionDenorm.check_queryset(queryset)
+
+    def get_queryset():
+        return queryset() if callable(queryset) else queryset
+
+    def func(instance):
+        rows = list(get_queryset().filter(**{outer_ref: instance.pk})[:1]) if instance.pk is not None else []
+        if not rows:
+            return field.get_default() if field.has_default() else None
+        return rows[0][0] if isinstance(rows[0], tuple) else rows[0]
+    func.expression = (queryset, outer_ref)
+    if immediate:
+        func.immediate = True
+    else:
+        func = depend_on_related(other_model, foreign_key=outer_ref, type='backward')(func)
+    field = denormalized(DBField, *args, **kwargs)(func)
+    return field
+
+
 class AggregateField(models.PositiveIntegerField):
 
     def get_denorm(self, *args, **kwargs):
@@ -106,10 +199,20 @@ class AggregateField(models.PositiveIntegerField):
         exclude:
             Do not include filter in aggregation
 
+        deferred:
+            If True, the triggers record changes in a table of pending
+            deltas instead of updating the value, so concurrent writes to
+            related rows of the same instance do not wait for each other.
+            ``flush()`` adds the deltas to the stored value, use
+            ``exact_value()`` to read the value including pending deltas.
+            Only supported for ForeignKeys to models with integer
+            primary keys.
+
         Any additional arguments are passed on to the contructor of
         PositiveIntegerField.
         """
         skip = kwargs.pop('skip', None)
+        deferred = kwargs.pop('deferred', False)
         qs_filter = kwargs.pop('filter', {})
         if qs_filter and hasattr(django.db.backend, 'sqlite3'):
             raise NotImplementedError('filters for aggregate fields are currently not supported for sqlite')
@@ -118,6 +221,7 @@ class AggregateField(models.PositiveIntegerField):
         self.denorm.manager_name = manager_name
         self.denorm.filter = qs_filter
         self.denorm.exclude = qs_exclude
+        self.denorm.deferred = deferred
         self.kwargs = kwargs
         kwargs['default'] = 0
         kwargs['editable'] = False
@@ -0,0 +1,47 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from denorm import denorms
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--field', action='store', type='string', dest='field_name',
+            default=None, help='Only check this denormalized field.'),
+        make_option('--sample', action='store', type='int', dest='sample',
+            default=None, help='Check about this many random instances of every model '
+                'instead of all of them.'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size',
+            default=None, help='The number of instances read at a time. '
+                'Defaults to %s.' % denorms.REBUILD_CHUNK_SIZE),
+        make_option('--sleep', action='store', type='float', dest='delay',
+            default=0, help='The time - in seconds - to pause after every chunk.'),
+        make_option('--examples', action='store', type='int', dest='examples',
+            default=10, help='The number of drifted primary keys to list per field. '
+                'Defaults to 10.'),
+        make_option('--json', action='store_true', dest='json',
+            default=False, help='Print the report as JSON.'),
+    )
+    help = "Compares denormalized values with freshly calculated ones, without changing anything."
+
+    def handle(self, model_name=None, *args, **kwargs):
+        report = denorms.audit(
+            model_name=model_name,
+            field_name=kwargs.get('field_name'),
+            sample=kwargs.get('sample'),
+            chunk_size=kwargs.get('chunk_size'),
+            delay=kwargs.get('delay') or 0,
+            examples=kwargs.get('examples', 10),
+        )
+
+        if kwargs.get('json'):
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        for row in report:
+            line = '%(model)s.%(field)s: %(drifted)s of %(checked)s drifted (%(percent).1f%%)' % dict(
+                row, percent=row['drift_rate'] * 100)
+            if row['examples']:
+                line += ', e.g. %s' % ', '.join(unicode(pk) for pk in row['examples'])
+            self.stdout.write(line)
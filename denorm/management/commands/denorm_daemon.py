@@ -1,15 +1,22 @@
+import logging
 import os
+import signal
 import sys
 from time import sleep
 from optparse import make_option
 
-from django.core.management.base import NoArgsCommand
-from django.db import transaction
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, connections, DatabaseError
 
-from denorm import denorms
+from denorm import denorms, metrics
+from denorm.db import triggers
+from denorm.scheduler import AdaptiveScheduler
 
 PID_FILE = "/tmp/django-denorm-daemon-pid"
 
+logger = logging.getLogger(__name__)
+
 
 class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
@@ -26,7 +33,9 @@ class Command(NoArgsCommand):
             type='int',
             dest='interval',
             default=1,
-            help='The interval - in seconds - between each update',
+            help='The interval - in seconds - between each update. '
+                 'With --listen the time to wait for a notification '
+                 'before checking for dirty fields anyway.',
         ),
         make_option(
             '-f', '--pidfile',
@@ -34,7 +43,88 @@ class Command(NoArgsCommand):
             type='string',
             dest='pidfile',
             default=PID_FILE,
-            help='The pid file to use. Defaults to "%s".' % PID_FILE)
+            help='The pid file to use. Defaults to "%s".' % PID_FILE),
+        make_option(
+            '--skip-locked',
+            action='store_true',
+            dest='skip_locked',
+            default=False,
+            help='Claim dirty rows with SELECT ... FOR UPDATE SKIP LOCKED, '
+                 'so several daemons can work on the same database. '
+                 'Every daemon needs its own pid file.',
+        ),
+        make_option(
+            '--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=None,
+            help='The number of dirty rows processed per transaction. '
+                 'Defaults to %s.' % denorms.FLUSH_CHUNK_SIZE,
+        ),
+        make_option(
+            '--listen',
+            action='store_true',
+            dest='listen',
+            default=False,
+            help='Wait for notifications on the DENORM_NOTIFY_CHANNEL '
+                 'instead of sleeping between updates (PostgreSQL only).',
+        ),
+        make_option(
+            '-w', '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help='The number of worker processes. Every worker updates its '
+                 'own share of the dirty fields. Crashed workers get restarted.',
+        ),
+        make_option(
+            '--shard-by',
+            action='store',
+            type='choice',
+            choices=['object', 'content_type'],
+            dest='shard_by',
+            default='object',
+            help='How to share the dirty fields between workers, by the id of '
+                 'the dirty object or by its content type. Defaults to "object".',
+        ),
+        make_option(
+            '--adaptive',
+            action='store_true',
+            dest='adaptive',
+            default=False,
+            help='Update dirty fields in batches sized to take about '
+                 '--target-latency each, without pausing while there is work '
+                 'and backing off up to the interval while there is none.',
+        ),
+        make_option(
+            '--target-latency',
+            action='store',
+            type='int',
+            dest='target_latency',
+            default=200,
+            help='The time - in milliseconds - one batch should take with --adaptive. '
+                 'Defaults to 200.',
+        ),
+        make_option(
+            '--metrics-port',
+            action='store',
+            type='int',
+            dest='metrics_port',
+            default=None,
+            help='Serve metrics in the Prometheus text format over HTTP on this port. '
+                 'With --workers every worker uses the port plus its number.',
+        ),
+        make_option(
+            '--metrics-address',
+            action='store',
+            type='string',
+            dest='metrics_address',
+            default='127.0.0.1',
+            help='The address to serve metrics on with --metrics-port. '
+                 'Defaults to "127.0.0.1", use "0.0.0.0" to accept remote connections.',
+        ),
     )
     help = "Runs a daemon that checks for dirty fields and updates them in regular intervals."
 
@@ -52,11 +142,16 @@ class Command(NoArgsCommand):
             else:
                 raise
 
-    @transaction.commit_manually
     def handle_noargs(self, **options):
         foreground = options['foreground']
-        interval = options['interval']
         pidfile = options['pidfile']
+        workers = options['workers']
+        channel = getattr(settings, 'DENORM_NOTIFY_CHANNEL', None)
+
+        if options['listen'] and not channel:
+            raise CommandError('--listen requires the DENORM_NOTIFY_CHANNEL setting')
+        if workers < 1:
+            raise CommandError('--workers needs to be at least 1')
 
         if self.pid_exists(pidfile):
             return
@@ -65,11 +160,96 @@ class Command(NoArgsCommand):
             from denorm import daemon
             daemon.daemonize(noClose=True, pidfile=pidfile)
 
+        if workers > 1:
+            self.supervise(workers, options)
+        else:
+            self.run(options)
+
+    def run(self, options, shard=None):
+        interval = options['interval']
+        skip_locked = options['skip_locked']
+        chunk_size = options['chunk_size']
+        listen = options['listen']
+        shard_by = options['shard_by'] + '_id'
+
+        listening = False
+
+        if options['metrics_port']:
+            sink = metrics.get_sink()
+            if not hasattr(sink, 'render'):
+                sink = metrics.PrometheusSink()
+                metrics.set_sink(sink)
+            metrics.serve(options['metrics_port'] + (shard[0] if shard else 0), sink, options['metrics_address'])
+
+        if options['adaptive']:
+            scheduler = AdaptiveScheduler(
+                target_latency=options['target_latency'] / 1000.0,
+                max_interval=interval,
+                batch_size=chunk_size,
+            )
+
+        # flush() commits after every chunk of dirty rows, so claimed rows
+        # never stay locked while we sleep.
         while True:
             try:
-                denorms.flush()
+                if listen and not listening:
+                    triggers.listen(connection, settings.DENORM_NOTIFY_CHANNEL)
+                    listening = True
+                if options['adaptive']:
+                    wait = scheduler.step(skip_locked=skip_locked, shard=shard, shard_by=shard_by)
+                else:
+                    denorms.flush(skip_locked=skip_locked, chunk_size=chunk_size, shard=shard, shard_by=shard_by)
+                    wait = interval
+                if not wait:
+                    continue
+                if listen:
+                    # Notifications may get lost, so we still check
+                    # for dirty rows every interval.
+                    triggers.wait_for_notify(connection, wait)
+                else:
+                    sleep(wait)
+            except DatabaseError, e:
+                # flush() already retried deadlocks, whatever is left may
+                # be a lost connection. Start over with a new one.
+                logger.exception(e)
+                connection.close()
+                listening = False
                 sleep(interval)
-                transaction.commit()
             except KeyboardInterrupt:
-                transaction.commit()
                 sys.exit()
+
+    def start_worker(self, index, workers, options):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run(options, shard=(index, workers))
+            finally:
+                os._exit(1)
+        return pid
+
+    def supervise(self, workers, options):
+        # Every worker needs database connections of its own.
+        for cconnection in connections.all():
+            cconnection.close()
+
+        children = {}
+        for index in range(workers):
+            children[self.start_worker(index, workers, options)] = index
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            while True:
+                pid, status = os.wait()
+                index = children.pop(pid, None)
+                if index is None:
+                    continue
+                self.stderr.write(self.style.ERROR("worker %s (pid %s) exited with status %s, restarting\n" % (index, pid, status)))
+                sleep(options['interval'])
+                children[self.start_worker(index, workers, options)] = index
+        except (KeyboardInterrupt, SystemExit):
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            sys.exit()
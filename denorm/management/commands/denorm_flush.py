@@ -1,9 +1,22 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from denorm import denorms
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--skip-locked', action='store_true', dest='skip_locked',
+            default=False, help='Skip dirty rows claimed by concurrent flushes '
+                'using SELECT ... FOR UPDATE SKIP LOCKED.'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size',
+            default=None, help='The number of dirty rows processed per transaction. '
+                'Defaults to %s.' % denorms.FLUSH_CHUNK_SIZE),
+    )
     help = "Recalculates the value of every denormalized field that was marked dirty."
 
     def handle(self, **kwargs):
-        denorms.flush()
+        denorms.flush(
+            skip_locked=kwargs.get('skip_locked', False),
+            chunk_size=kwargs.get('chunk_size'),
+        )
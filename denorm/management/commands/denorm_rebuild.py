@@ -1,10 +1,31 @@
-from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
 from denorm import denorms
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size',
+            default=None, help='The number of instances recalculated per transaction. '
+                'Defaults to %s.' % denorms.REBUILD_CHUNK_SIZE),
+        make_option('--jobs', action='store', type='int', dest='jobs',
+            default=1, help='The number of processes rebuilding ranges of '
+                'primary keys in parallel. Defaults to 1.'),
+        make_option('--resume', action='store_true', dest='resume',
+            default=False, help='Continue an interrupted rebuild after its last checkpoint.'),
+        make_option('--reset', action='store_true', dest='reset',
+            default=False, help='Discard the checkpoints of an interrupted rebuild and start over.'),
+    )
     help = "Recalculates the value of every single denormalized model field in the whole project."
 
     def handle(self, model_name=None, *args, **kwargs):
         verbosity = int((kwargs.get('verbosity', 0)))
-        denorms.rebuildall(verbose=verbosity > 1, model_name=model_name)
+        resume = kwargs.get('resume', False)
+        if resume and kwargs.get('reset'):
+            raise CommandError('--resume and --reset can not be combined')
+        if not resume and not kwargs.get('reset') and denorms.get_checkpoints(denorms.select_denorms(model_name)).exists():
+            raise CommandError('An interrupted rebuild left checkpoints behind, '
+                'use --resume to continue it or --reset to start over')
+        denorms.rebuildall(verbose=verbosity > 1, model_name=model_name, chunk_size=kwargs.get('chunk_size'),
+            jobs=kwargs.get('jobs') or 1, resume=resume)
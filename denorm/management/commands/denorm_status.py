@@ -0,0 +1,153 @@
+import json
+from time import sleep
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from denorm.db import triggers
+from denorm.models import DirtyInstance
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--json',
+            action='store_true',
+            dest='json',
+            default=False,
+            help='Print the report as JSON.',
+        ),
+        make_option(
+            '--top',
+            action='store',
+            type='int',
+            dest='top',
+            default=10,
+            help='The number of objects with the most dirty rows to list. Defaults to 10.',
+        ),
+        make_option(
+            '--sample',
+            action='store',
+            type='int',
+            dest='sample',
+            default=0,
+            help='The time - in seconds - to watch the dirty rows being processed '
+                 'to estimate the time until all of them are. '
+                 'Defaults to 0, which skips the estimate.',
+        ),
+    )
+    help = "Reports the dirty rows waiting to be processed by denorm_flush or denorm_daemon."
+
+    def query(self, sql, params=()):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(sql % {
+            'table': qn(DirtyInstance._meta.db_table),
+            'id': qn('id'),
+            'content_type_id': qn('content_type_id'),
+            'object_id': qn('object_id'),
+            'object_key': qn('object_key'),
+            'oldest': triggers.age_sql('MIN(%s)' % qn('created')),
+            'newest': triggers.age_sql('MAX(%s)' % qn('created')),
+        }, params)
+        return cursor.fetchall()
+
+    def content_type_name(self, content_type_id):
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        model = content_type.model_class()
+        if model is None:
+            # Markers may outlive the model they belong to.
+            return '%s.%s' % (content_type.app_label, content_type.model)
+        return unicode(model._meta)
+
+    def status(self, top, sample):
+        """
+        Collects the report with a handful of aggregate queries.
+        """
+        content_types = {}
+        for content_type_id, count, oldest, newest in self.query(
+            'SELECT %(content_type_id)s, COUNT(*), %(oldest)s, %(newest)s '
+            'FROM %(table)s GROUP BY %(content_type_id)s'
+        ):
+            content_types[content_type_id] = {
+                'content_type': self.content_type_name(content_type_id),
+                'markers': count,
+                'objects': 0,
+                'oldest_age': float(oldest or 0),
+                'newest_age': float(newest or 0),
+            }
+        # Objects marked for several fields or by several connections
+        # have more than one marker.
+        for content_type_id, count in self.query(
+            'SELECT %(content_type_id)s, COUNT(*) FROM ('
+            'SELECT DISTINCT %(content_type_id)s, %(object_id)s, %(object_key)s FROM %(table)s'
+            ') AS objects GROUP BY %(content_type_id)s'
+        ):
+            if content_type_id in content_types:
+                content_types[content_type_id]['objects'] = count
+
+        markers = sum(row['markers'] for row in content_types.values())
+        objects = sum(row['objects'] for row in content_types.values())
+        status = {
+            'markers': markers,
+            'objects': objects,
+            'duplicate_ratio': 1 - float(objects) / markers if markers else 0,
+            'oldest_age': max([row['oldest_age'] for row in content_types.values()] or [0]),
+            'newest_age': min([row['newest_age'] for row in content_types.values()] or [0]),
+            'content_types': sorted(content_types.values(), key=lambda row: -row['markers']),
+            'hot_objects': [
+                {
+                    'content_type': self.content_type_name(content_type_id),
+                    'object_id': object_key or object_id,
+                    'markers': count,
+                }
+                for content_type_id, object_id, object_key, count in self.query(
+                    'SELECT %(content_type_id)s, %(object_id)s, %(object_key)s, COUNT(*) FROM %(table)s '
+                    'GROUP BY %(content_type_id)s, %(object_id)s, %(object_key)s '
+                    'ORDER BY COUNT(*) DESC LIMIT %%s', [top]
+                )
+            ] if top else [],
+            'throughput': None,
+            'eta': None,
+        }
+
+        if sample and markers:
+            # Markers present now can only disappear, new ones get higher
+            # ids. Counting how many of them are gone after a while tells
+            # how fast the queue is processed.
+            max_id = self.query('SELECT MAX(%(id)s) FROM %(table)s')[0][0]
+            count_sql = 'SELECT COUNT(*) FROM %(table)s WHERE %(id)s <= %%s'
+            before = self.query(count_sql, [max_id])[0][0]
+            sleep(sample)
+            after = self.query(count_sql, [max_id])[0][0]
+            status['throughput'] = float(before - after) / sample
+            if status['throughput']:
+                status['eta'] = markers / status['throughput']
+        return status
+
+    def handle_noargs(self, **options):
+        status = self.status(options['top'], options['sample'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(status, indent=2))
+            return
+
+        self.stdout.write('%(markers)s dirty rows for %(objects)s objects (%(duplicate_ratio).1f%% duplicates)' % dict(
+            status, duplicate_ratio=status['duplicate_ratio'] * 100))
+        if status['markers']:
+            self.stdout.write('oldest %(oldest_age).0fs ago, newest %(newest_age).0fs ago' % status)
+        if status['throughput'] is not None:
+            if status['eta'] is not None:
+                self.stdout.write('%(throughput).1f rows per second, done in about %(eta).0fs' % status)
+            else:
+                self.stdout.write('no rows processed in the last %s seconds' % options['sample'])
+        if status['content_types']:
+            self.stdout.write('')
+            for row in status['content_types']:
+                self.stdout.write('%(content_type)-40s %(markers)10s rows %(objects)10s objects  oldest %(oldest_age).0fs' % row)
+        if status['hot_objects']:
+            self.stdout.write('')
+            for row in status['hot_objects']:
+                self.stdout.write('%(content_type)-40s %(object_id)20s %(markers)10s rows' % row)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and gauges describing the work done by ``flush()``.
+
+Metrics are reported to a sink, which is chosen with the
+``DENORM_METRICS_SINK`` setting (the dotted path of a class that gets
+instantiated without arguments). By default metrics are discarded.
+
+Reported metrics:
+
+``denorm_markers_processed_total`` (counter, per content type)
+    Dirty markers processed by ``flush()``.
+``denorm_rows_written_total`` (counter, per model)
+    Rows updated because a denormalized value changed.
+``denorm_callback_seconds_total`` (counter, per field)
+    Time spent computing denormalized values.
+``denorm_deltas_compacted_total`` (counter)
+    Pending deltas of deferred count and sum fields added to their values.
+``denorm_flush_passes_total`` (counter)
+    Passes over the dirty markers.
+``denorm_oldest_marker_age_seconds`` (gauge)
+    Age of the oldest dirty marker after a ``flush()``, 0 if there is none.
+"""
+import os
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from django.conf import settings
+
+try:
+    from django.utils.module_loading import import_by_path
+except ImportError:
+    # Django < 1.6
+    from django.utils.importlib import import_module
+
+    def import_by_path(dotted_path):
+        module_path, class_name = dotted_path.rsplit('.', 1)
+        return getattr(import_module(module_path), class_name)
+
+
+class NullSink(object):
+    """
+    Discards all metrics.
+    """
+    # Whether metrics that need extra queries should be collected.
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def publish(self):
+        """
+        Called after every ``flush()``, once all its metrics were reported.
+        """
+        pass
+
+
+class PrometheusSink(NullSink):
+    """
+    Keeps metrics in memory and renders them in the Prometheus text format.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        lines = []
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+            names = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in names:
+                    names.add(name)
+                    lines.append('# TYPE %s %s' % (name, kind))
+                if labels:
+                    labels = '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                else:
+                    labels = ''
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextFileSink(PrometheusSink):
+    """
+    Writes the metrics to the file named by the ``DENORM_METRICS_TEXTFILE``
+    setting after every ``flush()``, for the textfile collector of the
+    Prometheus node exporter.
+    """
+
+    def __init__(self, path=None):
+        super(PrometheusTextFileSink, self).__init__()
+        self.path = path or settings.DENORM_METRICS_TEXTFILE
+
+    def publish(self):
+        # Replace the file atomically, so it is never read half written.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(self.render().encode('utf-8'))
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, self.path)
+
+
+_sink = None
+
+
+def get_sink():
+    """
+    Returns the configured sink.
+    """
+    global _sink
+    if _sink is None:
+        path = getattr(settings, 'DENORM_METRICS_SINK', None)
+        _sink = import_by_path(path)() if path else NullSink()
+    return _sink
+
+
+def set_sink(sink):
+    """
+    Replaces the configured sink with ``sink``.
+    """
+    global _sink
+    _sink = sink
+
+
+def serve(port, sink, address='127.0.0.1'):
+    """
+    Serves the metrics of a ``PrometheusSink`` over HTTP on ``port`` from a
+    background thread and returns the server.
+    Only local connections are accepted unless another ``address`` to
+    listen on is given, e.g. ``''`` for all interfaces.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = sink.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from denorm import flush
+from denorm import flush, flush_current_transaction
+from django.conf import settings
 from django.db import DatabaseError
 import logging
 
@@ -14,10 +15,24 @@ class DenormMiddleware(object):
 
     As usual the order of middleware classes matters. It makes a lot of sense to put ``DenormMiddleware``
     after ``TransactionMiddleware`` in your ``MIDDLEWARE_CLASSES`` setting.
+
+    The work done per request can be limited with the ``DENORM_MIDDLEWARE_MAX_ITEMS`` and
+    ``DENORM_MIDDLEWARE_MAX_SECONDS`` settings. Only the oldest dirty rows within that budget
+    are updated then, the rest is left for later requests or a daemon.
+
+    With ``DENORM_MIDDLEWARE_CURRENT_TRANSACTION`` only the rows marked dirty by the
+    writes of the request's own database connection are updated, see
+    ``denorm.flush_current_transaction``.
     """
     def process_response(self, request, response):
         try:
-            flush()
+            if getattr(settings, 'DENORM_MIDDLEWARE_CURRENT_TRANSACTION', False):
+                flush_current_transaction()
+            else:
+                flush(
+                    max_items=getattr(settings, 'DENORM_MIDDLEWARE_MAX_ITEMS', None),
+                    max_seconds=getattr(settings, 'DENORM_MIDDLEWARE_MAX_SECONDS', None),
+                )
         except DatabaseError as e:
             logger.error(e)
         return response
@@ -0,0 +1,97 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+from denorm.models import INTEGER_FIELDS
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Renaming field 'DirtyInstance.object_id' to 'DirtyInstance.object_key'
+        db.rename_column('denorm_dirtyinstance', 'object_id', 'object_key')
+        db.execute("UPDATE denorm_dirtyinstance SET object_key = '' WHERE object_key IS NULL")
+
+        # Changing field 'DirtyInstance.object_key'
+        db.alter_column('denorm_dirtyinstance', 'object_key', self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True))
+
+        # Adding field 'DirtyInstance.object_id'
+        db.add_column('denorm_dirtyinstance', 'object_id', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Moving the keys of models with integer primary keys into 'DirtyInstance.object_id'
+        if not db.dry_run:
+            self.convert_integer_keys(orm)
+
+        # Removing duplicate markers
+        db.execute(
+            'DELETE FROM denorm_dirtyinstance WHERE id NOT IN ('
+            'SELECT id FROM (SELECT MIN(id) AS id FROM denorm_dirtyinstance '
+            'GROUP BY content_type_id, object_id, object_key, field_name) AS keep)'
+        )
+
+        # Adding unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name']
+        db.create_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name'])
+
+        # Adding index on 'DirtyInstance', fields ['content_type', 'id']
+        db.create_index('denorm_dirtyinstance', ['content_type_id', 'id'])
+
+
+    def convert_integer_keys(self, orm):
+        for content_type in orm['contenttypes.ContentType'].objects.filter(
+                pk__in=[row[0] for row in db.execute('SELECT DISTINCT content_type_id FROM denorm_dirtyinstance')]):
+            model = models.get_model(content_type.app_label, content_type.model)
+            if model is None:
+                continue
+            pk = model._meta.pk
+            while pk.rel:
+                pk = pk.rel.get_related_field()
+            if pk.get_internal_type() not in INTEGER_FIELDS:
+                continue
+            for marker_id, object_key in db.execute(
+                    'SELECT id, object_key FROM denorm_dirtyinstance WHERE content_type_id = %s', [content_type.pk]):
+                object_key = object_key.strip()
+                if object_key.lstrip('-').isdigit():
+                    db.execute("UPDATE denorm_dirtyinstance SET object_id = %s, object_key = '' WHERE id = %s", [int(object_key), marker_id])
+
+    def backwards(self, orm):
+
+        # Removing index on 'DirtyInstance', fields ['content_type', 'id']
+        db.delete_index('denorm_dirtyinstance', ['content_type_id', 'id'])
+
+        # Removing unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name']
+        db.delete_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name'])
+
+        # Moving integer keys back into the text column
+        db.execute("UPDATE denorm_dirtyinstance SET object_key = CAST(object_id AS CHAR(100)) WHERE object_key = ''")
+
+        # Deleting field 'DirtyInstance.object_id'
+        db.delete_column('denorm_dirtyinstance', 'object_id')
+
+        # Changing field 'DirtyInstance.object_key'
+        db.alter_column('denorm_dirtyinstance', 'object_key', self.gf('django.db.models.fields.TextField')(null=True, blank=True))
+
+        # Renaming field 'DirtyInstance.object_key' to 'DirtyInstance.object_id'
+        db.rename_column('denorm_dirtyinstance', 'object_key', 'object_id')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key', 'field_name'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['denorm']
@@ -0,0 +1,59 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Removing unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name']
+        db.delete_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name'])
+
+        # Adding field 'DirtyInstance.tag'
+        db.add_column('denorm_dirtyinstance', 'tag', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Adding unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name', 'tag']
+        db.create_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name', 'tag'])
+
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name', 'tag']
+        db.delete_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name', 'tag'])
+
+        # Removing markers that only differ in their tag
+        db.execute(
+            'DELETE FROM denorm_dirtyinstance WHERE id NOT IN ('
+            'SELECT id FROM (SELECT MIN(id) AS id FROM denorm_dirtyinstance '
+            'GROUP BY content_type_id, object_id, object_key, field_name) AS keep)'
+        )
+
+        # Deleting field 'DirtyInstance.tag'
+        db.delete_column('denorm_dirtyinstance', 'tag')
+
+        # Adding unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name']
+        db.create_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name'])
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key', 'field_name', 'tag'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['denorm']
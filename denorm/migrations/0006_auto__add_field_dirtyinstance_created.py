@@ -0,0 +1,42 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+from django.utils import timezone
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding field 'DirtyInstance.created'
+        db.add_column('denorm_dirtyinstance', 'created', self.gf('django.db.models.fields.DateTimeField')(default=timezone.now), keep_default=False)
+
+
+    def backwards(self, orm):
+
+        # Deleting field 'DirtyInstance.created'
+        db.delete_column('denorm_dirtyinstance', 'created')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key', 'field_name', 'tag'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['denorm']
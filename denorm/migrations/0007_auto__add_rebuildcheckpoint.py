@@ -0,0 +1,66 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding model 'RebuildCheckpoint'
+        db.create_table('denorm_rebuildcheckpoint', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('field_names', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('min_pk', self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True)),
+            ('max_pk', self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True)),
+            ('last_pk', self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True)),
+            ('done', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal('denorm', ['RebuildCheckpoint'])
+
+        # Adding unique constraint on 'RebuildCheckpoint', fields ['content_type', 'field_names', 'min_pk']
+        db.create_unique('denorm_rebuildcheckpoint', ['content_type_id', 'field_names', 'min_pk'])
+
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'RebuildCheckpoint', fields ['content_type', 'field_names', 'min_pk']
+        db.delete_unique('denorm_rebuildcheckpoint', ['content_type_id', 'field_names', 'min_pk'])
+
+        # Deleting model 'RebuildCheckpoint'
+        db.delete_table('denorm_rebuildcheckpoint')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key', 'field_name', 'tag'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        'denorm.rebuildcheckpoint': {
+            'Meta': {'unique_together': "(('content_type', 'field_names', 'min_pk'),)", 'object_name': 'RebuildCheckpoint'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'done': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'field_names': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'max_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'min_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['denorm']
@@ -0,0 +1,72 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding model 'AggregateDelta'
+        db.create_table('denorm_aggregatedelta', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('object_id', self.gf('django.db.models.fields.BigIntegerField')()),
+            ('field_name', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('delta', self.gf('django.db.models.fields.BigIntegerField')()),
+        ))
+        db.send_create_signal('denorm', ['AggregateDelta'])
+
+        # Adding index on 'AggregateDelta', fields ['content_type', 'field_name', 'object_id']
+        db.create_index('denorm_aggregatedelta', ['content_type_id', 'field_name', 'object_id'])
+
+
+    def backwards(self, orm):
+
+        # Removing index on 'AggregateDelta', fields ['content_type', 'field_name', 'object_id']
+        db.delete_index('denorm_aggregatedelta', ['content_type_id', 'field_name', 'object_id'])
+
+        # Deleting model 'AggregateDelta'
+        db.delete_table('denorm_aggregatedelta')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.aggregatedelta': {
+            'Meta': {'object_name': 'AggregateDelta', 'index_together': "[('content_type', 'field_name', 'object_id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'delta': ('django.db.models.fields.BigIntegerField', [], {}),
+            'field_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key', 'field_name', 'tag'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        'denorm.rebuildcheckpoint': {
+            'Meta': {'unique_together': "(('content_type', 'field_names', 'min_pk'),)", 'object_name': 'RebuildCheckpoint'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'done': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'field_names': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'max_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'min_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['denorm']
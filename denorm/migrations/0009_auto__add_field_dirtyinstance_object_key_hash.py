@@ -0,0 +1,86 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+from denorm.db import triggers
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Removing unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name', 'tag']
+        db.delete_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name', 'tag'])
+
+        # Changing field 'DirtyInstance.object_key'
+        db.alter_column('denorm_dirtyinstance', 'object_key', self.gf('django.db.models.fields.TextField')(default='', blank=True))
+
+        # Adding field 'DirtyInstance.object_key_hash'
+        db.add_column('denorm_dirtyinstance', 'object_key_hash', self.gf('django.db.models.fields.CharField')(default='', max_length=32, blank=True), keep_default=False)
+
+        # Hashing the keys of existing markers the way the triggers do
+        db.execute("UPDATE denorm_dirtyinstance SET object_key_hash = %s WHERE object_key <> ''" % triggers.key_hash_sql('object_key'))
+
+        # Adding unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key_hash', 'field_name', 'tag']
+        db.create_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key_hash', 'field_name', 'tag'])
+
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key_hash', 'field_name', 'tag']
+        db.delete_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key_hash', 'field_name', 'tag'])
+
+        # Deleting field 'DirtyInstance.object_key_hash'
+        db.delete_column('denorm_dirtyinstance', 'object_key_hash')
+
+        # Removing markers whose key does not fit the old column
+        db.execute('DELETE FROM denorm_dirtyinstance WHERE LENGTH(object_key) > 100')
+
+        # Changing field 'DirtyInstance.object_key'
+        db.alter_column('denorm_dirtyinstance', 'object_key', self.gf('django.db.models.fields.CharField')(default='', max_length=100, blank=True))
+
+        # Adding unique constraint on 'DirtyInstance', fields ['content_type', 'object_id', 'object_key', 'field_name', 'tag']
+        db.create_unique('denorm_dirtyinstance', ['content_type_id', 'object_id', 'object_key', 'field_name', 'tag'])
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'denorm.aggregatedelta': {
+            'Meta': {'object_name': 'AggregateDelta', 'index_together': "[('content_type', 'field_name', 'object_id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'delta': ('django.db.models.fields.BigIntegerField', [], {}),
+            'field_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {})
+        },
+        'denorm.dirtyinstance': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'object_key_hash', 'field_name', 'tag'),)", 'object_name': 'DirtyInstance', 'index_together': "[('content_type', 'id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'field_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'object_key': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'object_key_hash': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        'denorm.rebuildcheckpoint': {
+            'Meta': {'unique_together': "(('content_type', 'field_names', 'min_pk'),)", 'object_name': 'RebuildCheckpoint'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'done': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'field_names': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'max_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'}),
+            'min_pk': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['denorm']
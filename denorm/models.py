@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.contenttypes import generic
+from django.utils import timezone
+
+INTEGER_FIELDS = (
+    'AutoField', 'BigIntegerField', 'IntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField',
+)
 
 
 class DirtyInstance(models.Model):
@@ -10,10 +15,99 @@ class DirtyInstance(models.Model):
     that needs to be recalculated.
     DirtyInstance instances are created by the insert/update/delete triggers
     when related objects change.
+    Every instance is marked at most once per field and writing
+    connection, the triggers silently skip markers that already exist.
+    The connection ``tag`` is part of the unique key, so
+    ``flush_current_transaction()`` always finds the markers of its own
+    writes even if another connection marked the same instance before.
+    The price is one marker per concurrently writing connection in the
+    worst case. ``flush()`` merges them and recomputes the instance once.
     """
     content_type = models.ForeignKey(ContentType)
-    object_id = models.TextField(blank=True, null=True)
-    content_object = generic.GenericForeignKey()
+    # Integer primary keys are stored in object_id, any other primary key
+    # is stored as text in object_key.
+    object_id = models.BigIntegerField(default=0)
+    object_key = models.TextField(blank=True, default='')
+    # A fixed length hash of object_key for the unique key, as primary
+    # keys may be longer than an index allows.
+    object_key_hash = models.CharField(max_length=32, blank=True, default='')
+    # The denormalized field that needs to be recalculated,
+    # empty if all of them need to be.
+    field_name = models.CharField(max_length=64, blank=True, default='')
+    # Identifies the database connection whose writes created the marker.
+    tag = models.BigIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'object_key_hash', 'field_name', 'tag')
+        index_together = [('content_type', 'id')]
+
+    @staticmethod
+    def has_integer_key(model):
+        """
+        Returns whether instances of ``model`` are referenced by object_id.
+        """
+        pk = model._meta.pk
+        while pk.rel:
+            pk = pk.rel.get_related_field()
+        return pk.get_internal_type() in INTEGER_FIELDS
+
+    @property
+    def object_pk(self):
+        return self.object_key or self.object_id
+
+    @property
+    def content_object(self):
+        model = self.content_type.model_class()
+        try:
+            return model._base_manager.get(pk=self.object_pk)
+        except model.DoesNotExist:
+            return None
+
+    def __unicode__(self):
+        if self.field_name:
+            return u'DirtyInstance: %s, %s, %s' % (self.content_type, self.object_pk, self.field_name)
+        return u'DirtyInstance: %s, %s' % (self.content_type, self.object_pk)
+
+
+class RebuildCheckpoint(models.Model):
+    """
+    Records how far ``rebuildall()`` got rebuilding the given fields of a
+    model, so an interrupted rebuild can be resumed.
+    Parallel rebuilds keep one checkpoint per range of primary keys.
+    All checkpoints are deleted once a rebuild completes.
+    """
+    content_type = models.ForeignKey(ContentType)
+    # Comma separated names of the rebuilt fields.
+    field_names = models.CharField(max_length=255)
+    # The range of primary keys to rebuild, empty if unbounded.
+    min_pk = models.CharField(max_length=100, blank=True, default='')
+    max_pk = models.CharField(max_length=100, blank=True, default='')
+    # The primary key of the last rebuilt instance, empty if none was yet.
+    last_pk = models.CharField(max_length=100, blank=True, default='')
+    done = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('content_type', 'field_names', 'min_pk')
+
+    def __unicode__(self):
+        return u'RebuildCheckpoint: %s, %s, %s' % (self.content_type, self.field_names, self.last_pk or '-')
+
+
+class AggregateDelta(models.Model):
+    """
+    A pending change to a deferred count or sum field.
+    The triggers only ever insert deltas, so concurrent writes never wait
+    for each other on the row holding the value. ``compact()`` adds them
+    to the stored values and deletes them.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.BigIntegerField()
+    field_name = models.CharField(max_length=64)
+    delta = models.BigIntegerField()
+
+    class Meta:
+        index_together = [('content_type', 'field_name', 'object_id')]
 
     def __unicode__(self):
-        return u'DirtyInstance: %s, %s' % (self.content_type, self.object_id)
+        return u'AggregateDelta: %s, %s, %s, %+d' % (self.content_type, self.object_id, self.field_name, self.delta)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from denorm import denorms
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveScheduler(object):
+    """
+    Decides how many dirty rows the daemon updates at once and how long
+    it waits between updates.
+
+    While there are dirty rows the batches follow each other without a
+    pause, and the batch size is adjusted so a batch takes about
+    ``target_latency`` seconds. Row locks are only held that long.
+    When there is nothing to do the pause doubles up to ``max_interval``.
+    """
+
+    def __init__(self, target_latency=0.2, min_interval=0.1, max_interval=10,
+                 batch_size=None, min_batch_size=10, max_batch_size=10000):
+        self.target_latency = target_latency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size = batch_size or denorms.FLUSH_CHUNK_SIZE
+        self.interval = min_interval
+
+    def step(self, **kwargs):
+        """
+        Updates one batch of dirty rows and returns the number of seconds
+        to wait before the next step. Keyword arguments are passed on to
+        ``flush()``.
+        """
+        started = time.time()
+        processed = denorms.flush(max_items=self.batch_size, chunk_size=self.batch_size, **kwargs)
+        return self.update(processed, time.time() - started)
+
+    def update(self, processed, elapsed):
+        """
+        Adjusts the batch size and interval after a batch of ``processed``
+        rows that took ``elapsed`` seconds, returns the time to wait.
+        """
+        if not processed:
+            interval = min(max(self.interval * 2, self.min_interval), self.max_interval)
+            if interval != self.interval:
+                logger.debug('no dirty rows, waiting %.2fs', interval)
+            self.interval = interval
+            return interval
+
+        self.interval = 0
+        # Only full batches tell whether the batch size can grow,
+        # but any batch that took too long means it has to shrink.
+        if processed >= self.batch_size or elapsed > self.target_latency:
+            factor = self.target_latency / max(elapsed, 0.001)
+            factor = min(max(factor, 0.5), 2)
+            batch_size = int(self.batch_size * factor)
+            batch_size = min(max(batch_size, self.min_batch_size), self.max_batch_size)
+            if batch_size != self.batch_size:
+                logger.info('%s rows took %.3fs, batch size is now %s', processed, elapsed, batch_size)
+            self.batch_size = batch_size
+        return 0
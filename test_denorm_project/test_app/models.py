@@ -1,12 +1,13 @@
 import django
 from django.conf import settings
 from django.db import models
+from django.db.models import Count
 from django.contrib.contenttypes.generic import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 
 from denorm.fields import SumField
-from denorm import denormalized, depend_on_related, CountField, CacheKeyField, cached
+from denorm import denormalized, denormalized_expression, depend_on_related, CountField, CacheKeyField, cached
 
 
 settings.DENORM_MODEL = 'denorm.RealDenormModel'
@@ -99,6 +100,9 @@ class Forum(TaggedModel):
     # Simple count() aggregate
     post_count = CountField('post_set')
 
+    # Same count, updated from pending deltas by flush()
+    deferred_post_count = CountField('post_set', deferred=True)
+
     cachekey = CacheKeyField()
     cachekey.depend_on_related('Post')
 
@@ -195,6 +199,38 @@ class Member(models.Model):
         if self.id:
             return '\n'.join([p.title for p in self.bookmarks.all()])
 
+    # Computed by the database
+    latest_post_title = denormalized_expression(
+        models.CharField, lambda: Post.objects.order_by('-pk').values_list('title'), 'Post.author',
+        max_length=255, default='',
+    )
+
+    # Kept up to date by the triggers on Post, without flush()
+    has_posts = denormalized_expression(
+        models.BooleanField, lambda: Post.objects.extra(select={'one': 'TRUE'}).values_list('one'), 'Post.author',
+        immediate=True, default=False,
+    )
+
+    # Counts the bookmarks of many members with a single query
+    @denormalized(models.PositiveIntegerField, default=0, batch=True)
+    @depend_on_related('Post', foreign_key="bookmarks")
+    def bookmark_count(members):
+        counts = Member.bookmarks.through.objects.filter(
+            member__in=[member.pk for member in members if member.pk],
+        ).values('member').annotate(count=Count('post'))
+        return dict((row['member'], row['count']) for row in counts)
+
+
+class Label(models.Model):
+    # Instances are referenced by a long text primary key.
+    name = models.CharField(max_length=255, primary_key=True)
+    forum = models.ForeignKey(Forum)
+
+    @denormalized(models.CharField, max_length=255)
+    @depend_on_related(Forum)
+    def forum_title(self):
+        return self.forum.title
+
 
 class SkipPost(models.Model):
     # Skip feature test main model.
@@ -1,12 +1,28 @@
+import copy
+import json
+import logging
+import os
+import tempfile
+from StringIO import StringIO
+
 import django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
+from django.db import connection, DatabaseError
+
 import denorm
-from denorm import denorms
+from denorm import denorms, metrics
+from denorm.db import triggers
+from denorm.management.commands import denorm_daemon
+from denorm.middleware import DenormMiddleware
+from denorm.models import AggregateDelta, DirtyInstance, RebuildCheckpoint
+from denorm.scheduler import AdaptiveScheduler
 import models
 
 # Use all but denorms in FailingTriggers models by default
@@ -72,6 +88,141 @@ class TestAbstract(TestCase):
         self.assertEqual("Eggs and onion", d1.eggs)
 
 
+class TestAdaptiveScheduler(TestCase):
+    def setUp(self):
+        denorms.drop_triggers()
+        denorms.install_triggers()
+
+    def test_backoff(self):
+        scheduler = AdaptiveScheduler(min_interval=0.1, max_interval=1)
+        self.assertEqual([scheduler.update(0, 0) for i in range(5)], [0.2, 0.4, 0.8, 1, 1])
+        self.assertEqual(scheduler.update(1, 0), 0)
+        self.assertEqual(scheduler.update(0, 0), 0.1)
+
+    def test_batch_size(self):
+        scheduler = AdaptiveScheduler(target_latency=0.2, batch_size=100)
+        scheduler.update(100, 0.05)
+        self.assertEqual(scheduler.batch_size, 200)
+        scheduler.update(200, 0.4)
+        self.assertEqual(scheduler.batch_size, 100)
+        # partial batches that finish in time say nothing about the limit
+        scheduler.update(10, 0.01)
+        self.assertEqual(scheduler.batch_size, 100)
+
+    def test_step(self):
+        models.Forum.objects.create(title="forumone")
+        scheduler = AdaptiveScheduler(batch_size=1)
+        self.assertEqual(scheduler.step(), 0)
+        self.assertFalse(DirtyInstance.objects.exists())
+        self.assertTrue(scheduler.step() > 0)
+
+
+class TestDaemon(TestCase):
+    def setUp(self):
+        self.pidfile = os.path.join(tempfile.mkdtemp(), 'denorm.pid')
+
+    def test_listen(self):
+        # A notification and a timed out wait both lead to the next flush.
+        events = []
+        notifications = [True, False]
+
+        class Backend(object):
+            def listen(self, connection, channel):
+                events.append(('listen', channel))
+
+            def wait_for_notify(self, connection, timeout):
+                events.append(('wait', timeout))
+                if not notifications:
+                    raise KeyboardInterrupt
+                return notifications.pop(0)
+
+        backend, flush, sleep = denorm_daemon.triggers, denorms.flush, denorm_daemon.sleep
+        denorm_daemon.triggers = Backend()
+        denorms.flush = lambda **kwargs: events.append('flush')
+        denorm_daemon.sleep = lambda seconds: events.append(('sleep', seconds))
+        try:
+            with self.settings(DENORM_NOTIFY_CHANNEL='denorm'):
+                self.assertRaises(
+                    SystemExit, call_command, 'denorm_daemon',
+                    foreground=True, listen=True, interval=5, pidfile=self.pidfile,
+                )
+        finally:
+            denorm_daemon.triggers, denorms.flush, denorm_daemon.sleep = backend, flush, sleep
+        self.assertEqual(events, [
+            ('listen', 'denorm'),
+            'flush', ('wait', 5),
+            'flush', ('wait', 5),
+            'flush', ('wait', 5),
+        ])
+
+
+    def test_workers(self):
+        # Crashed workers get restarted, on shutdown all get terminated.
+        events = []
+        pids = [101, 102, 103]
+        exits = [(101, 256), (999, 0)]
+
+        def fork():
+            events.append('fork')
+            return pids.pop(0)
+
+        def wait():
+            if not exits:
+                raise KeyboardInterrupt
+            return exits.pop(0)
+
+        def kill(pid, signum):
+            events.append(('kill', pid))
+            if pid == 102:
+                raise OSError
+
+        class Connection(object):
+            def __init__(self, alias):
+                self.alias = alias
+
+            def close(self):
+                events.append(('close', self.alias))
+
+        class Connections(object):
+            def all(self):
+                return [Connection('default'), Connection('other')]
+
+        command = denorm_daemon.Command()
+        command.stderr = StringIO()
+        originals = os.fork, os.wait, os.kill, denorm_daemon.sleep, denorm_daemon.connections
+        sigterm = denorm_daemon.signal.getsignal(denorm_daemon.signal.SIGTERM)
+        os.fork, os.wait, os.kill = fork, wait, kill
+        denorm_daemon.sleep = lambda seconds: events.append(('sleep', seconds))
+        denorm_daemon.connections = Connections()
+        try:
+            self.assertRaises(SystemExit, command.supervise, 2, {'interval': 5})
+        finally:
+            os.fork, os.wait, os.kill, denorm_daemon.sleep, denorm_daemon.connections = originals
+            denorm_daemon.signal.signal(denorm_daemon.signal.SIGTERM, sigterm)
+        self.assertEqual(events[:6], [('close', 'default'), ('close', 'other'), 'fork', 'fork', ('sleep', 5), 'fork'])
+        self.assertEqual(sorted(events[6:]), [('kill', 102), ('kill', 103)])
+        self.assertIn('worker 0 (pid 101) exited with status 256, restarting', command.stderr.getvalue())
+
+    def test_start_worker(self):
+        # The forked child runs its shard and never returns.
+        shards = []
+
+        class Exited(Exception):
+            pass
+
+        def exit(status):
+            raise Exited(status)
+
+        command = denorm_daemon.Command()
+        command.run = lambda options, shard=None: shards.append(shard)
+        fork, _exit = os.fork, os._exit
+        os.fork, os._exit = lambda: 0, exit
+        try:
+            self.assertRaises(Exited, command.start_worker, 1, 2, {})
+        finally:
+            os.fork, os._exit = fork, _exit
+        self.assertEqual(shards, [(1, 2)])
+
 class TestSkip(TestCase):
     """
     Tests for the skip feature.
@@ -113,6 +264,46 @@ class TestSkip(TestCase):
         denorm.flush()
 
 
+class TestRetry(TransactionTestCase):
+
+    def test_retry_chunks(self):
+        attempts = []
+
+        def deadlock():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise DatabaseError('deadlock detected')
+            return 'done'
+
+        is_retryable, retry_delay = triggers.is_retryable, denorms.FLUSH_RETRY_DELAY
+        triggers.is_retryable = lambda error: 'deadlock' in str(error)
+        denorms.FLUSH_RETRY_DELAY = 0
+        try:
+            self.assertEqual(denorms.run_in_transaction(deadlock), 'done')
+            self.assertEqual(len(attempts), 3)
+
+            self.assertRaises(DatabaseError, denorms.run_in_transaction, lambda: connection.cursor().execute('SELECT * FROM no_such_table'))
+        finally:
+            triggers.is_retryable, denorms.FLUSH_RETRY_DELAY = is_retryable, retry_delay
+
+    def test_retry_nested(self):
+        attempts = []
+
+        def deadlock():
+            attempts.append(1)
+            raise DatabaseError('deadlock detected')
+
+        is_retryable, retry_delay = triggers.is_retryable, denorms.FLUSH_RETRY_DELAY
+        triggers.is_retryable = lambda error: 'deadlock' in str(error)
+        denorms.FLUSH_RETRY_DELAY = 0
+        try:
+            with denorms.atomic():
+                self.assertRaises(DatabaseError, denorms.run_in_transaction, deadlock)
+        finally:
+            triggers.is_retryable, denorms.FLUSH_RETRY_DELAY = is_retryable, retry_delay
+        self.assertEqual(len(attempts), 1)
+
+
 class TestDenormalisation(TestCase):
     """
     Tests for the denormalisation fields.
@@ -221,6 +412,105 @@ class TestDenormalisation(TestCase):
         self.assertEqual(f2.path, '/someothertitle/forumtwo/')
         self.assertEqual(f3.path, '/someothertitle/forumtwo/forumthree/')
 
+    def test_field_scoped_markers(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        denorm.flush()
+
+        models.Forum.objects.filter(pk=f1.pk).update(title="forumtwo")
+        post_markers = DirtyInstance.objects.filter(
+            content_type=ContentType.objects.get_for_model(models.Post),
+            object_id=p1.pk,
+        )
+        self.assertEqual(set(post_markers.values_list('field_name', flat=True)), set(['forum_title']))
+
+        # Writing forum_title must not mark the post again for all fields.
+        calls = []
+        post_denorms = denorms.get_callback_denorms()[models.Post]
+        funcs = dict((denorm_, denorm_.func) for denorm_ in post_denorms)
+
+        def counting(denorm_, func):
+            def wrapper(instance):
+                calls.append(denorm_.fieldname)
+                return func(instance)
+            return wrapper
+        for denorm_, func in funcs.items():
+            denorm_.func = counting(denorm_, func)
+        try:
+            denorm.flush()
+        finally:
+            for denorm_, func in funcs.items():
+                denorm_.func = func
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "forumtwo")
+        # The forum's path changed too, which marks forum_title once more.
+        self.assertEqual(set(calls), set(['forum_title']))
+
+    def test_markers_are_unique(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        denorm.flush()
+
+        for title in ("forumtwo", "forumthree", "forumfour"):
+            models.Forum.objects.filter(pk=f1.pk).update(title=title)
+        post_markers = DirtyInstance.objects.filter(
+            content_type=ContentType.objects.get_for_model(models.Post),
+            object_id=p1.pk,
+        )
+        self.assertEqual(post_markers.filter(field_name='forum_title').count(), 1)
+
+        denorm.flush()
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "forumfour")
+        self.assertEqual(DirtyInstance.objects.count(), 0)
+
+    def test_long_text_keys(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        name = 'label' * 50
+        models.Label.objects.create(name=name, forum=f1)
+        denorm.flush()
+
+        for title in ("forumtwo", "forumthree"):
+            models.Forum.objects.filter(pk=f1.pk).update(title=title)
+        markers = DirtyInstance.objects.filter(content_type=ContentType.objects.get_for_model(models.Label))
+        self.assertEqual(list(markers.values_list('object_key', 'field_name')), [(name, 'forum_title')])
+
+        denorm.flush()
+        self.assertEqual(models.Label.objects.get(pk=name).forum_title, "forumthree")
+
+        # Other databases can not index long keys, markers are unique on their hash.
+        from denorm import dependencies
+        from denorm.db.postgresql import triggers as pg_triggers
+        dependencies.triggers = pg_triggers
+        try:
+            action = dependencies.dirty_instance_action(models.Label, '1', 'NEW."name"')
+        finally:
+            dependencies.triggers = triggers
+        self.assertIn('md5(CAST(NEW."name" AS text))', action.values)
+
+    def test_flush_order(self):
+        order = denorms.get_flush_order(denorms.get_callback_denorms())
+        position = dict((model, i) for i, group in enumerate(order) for model in group)
+
+        # Forum and Post depend on each other, Attachment depends on both.
+        self.assertEqual(position[models.Forum], position[models.Post])
+        self.assertTrue(position[models.Post] < position[models.Attachment])
+
+    def test_trees_settle_in_one_pass(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo", parent_forum=f1)
+        f3 = models.Forum.objects.create(title="forumthree", parent_forum=f2)
+        models.Post.objects.create(forum=f3)
+        denorm.flush()
+
+        models.Forum.objects.filter(pk=f1.pk).update(title='someothertitle')
+        sink = metrics.PrometheusSink()
+        metrics.set_sink(sink)
+        try:
+            denorm.flush()
+        finally:
+            metrics.set_sink(None)
+        self.assertEqual(sink.counters[('denorm_flush_passes_total', ())], 1)
+        self.assertEqual(models.Forum.objects.get(id=f3.id).path, '/someothertitle/forumtwo/forumthree/')
+
     def test_reverse_fk_null(self):
         f1 = models.Forum.objects.create(title="forumone")
         m1 = models.Member.objects.create(name="memberone")
@@ -255,6 +545,294 @@ class TestDenormalisation(TestCase):
         self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "oneforall")
         self.assertEqual(models.Post.objects.get(id=p2.id).forum_title, "oneforall")
 
+    def test_flush_in_chunks(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        posts = [models.Post.objects.create(forum=f) for f in forums]
+        denorm.flush(chunk_size=2)
+
+        for i, forum in enumerate(forums):
+            models.Forum.objects.filter(pk=forum.pk).update(title="renamed%s" % i)
+        call_command('denorm_flush', chunk_size=2)
+
+        for i, post in enumerate(posts):
+            self.assertEqual(models.Post.objects.get(id=post.id).forum_title, "renamed%s" % i)
+        self.assertFalse(DirtyInstance.objects.exists())
+
+    def test_flush_budget(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        posts = [models.Post.objects.create(forum=f) for f in forums]
+        denorm.flush()
+
+        models.Forum.objects.update(title="renamed")
+        oldest = list(DirtyInstance.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(denorm.flush(max_items=3, chunk_size=2), 3)
+        self.assertFalse(DirtyInstance.objects.filter(id__in=oldest[:3]).exists())
+        self.assertTrue(DirtyInstance.objects.filter(id__in=oldest[3:]).exists())
+
+        self.assertEqual(denorm.flush(max_seconds=0), 0)
+
+        denorm.flush()
+        for post in posts:
+            self.assertEqual(models.Post.objects.get(id=post.id).forum_title, "renamed")
+
+        # Pending deltas of deferred fields use up the same budget.
+        models.Post.objects.create(forum=forums[0])
+        models.Post.objects.create(forum=forums[1])
+        self.assertEqual(AggregateDelta.objects.count(), 2)
+        oldest = list(DirtyInstance.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(denorm.flush(max_items=3), 3)
+        self.assertFalse(AggregateDelta.objects.exists())
+        self.assertFalse(DirtyInstance.objects.filter(id=oldest[0]).exists())
+        self.assertTrue(DirtyInstance.objects.filter(id__in=oldest[1:]).exists())
+
+    def test_flush_current_transaction(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f2)
+        denorm.flush()
+
+        tag = denorms.get_connection_tag()
+        models.Forum.objects.filter(pk=f1.pk).update(title="renamed")
+        self.assertEqual(set(DirtyInstance.objects.values_list('tag', flat=True)), set([tag]))
+
+        # pretend an other connection changed the second forum
+        models.Forum.objects.filter(pk=f2.pk).update(title="renamed")
+        for instance in (f2, p2):
+            DirtyInstance.objects.filter(
+                content_type=ContentType.objects.get_for_model(instance),
+                object_id=instance.pk,
+            ).update(tag=tag + 1)
+
+        denorm.flush_current_transaction()
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "renamed")
+        self.assertEqual(models.Post.objects.get(id=p2.id).forum_title, "forumtwo")
+        self.assertEqual(set(DirtyInstance.objects.values_list('tag', flat=True)), set([tag + 1]))
+
+    def test_middleware_current_transaction(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f2)
+        denorm.flush()
+
+        tag = denorms.get_connection_tag()
+        models.Forum.objects.filter(pk__in=[f1.pk, f2.pk]).update(title="renamed")
+        # pretend an other connection changed the second forum
+        for instance in (f2, p2):
+            DirtyInstance.objects.filter(
+                content_type=ContentType.objects.get_for_model(instance),
+                object_id=instance.pk,
+            ).update(tag=tag + 1)
+
+        response = object()
+        with self.settings(DENORM_MIDDLEWARE_CURRENT_TRANSACTION=True):
+            self.assertIs(DenormMiddleware().process_response(None, response), response)
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "renamed")
+        self.assertEqual(models.Post.objects.get(id=p2.id).forum_title, "forumtwo")
+
+    def test_markers_per_connection(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        denorm.flush()
+        post_markers = DirtyInstance.objects.filter(content_type=ContentType.objects.get_for_model(models.Post))
+
+        tag = denorms.get_connection_tag()
+        models.Forum.objects.filter(pk=f1.pk).update(title="renamed")
+        # pretend an other connection marked the post first
+        post_markers.update(tag=tag + 1)
+
+        # this connection adds a marker of its own, but only one
+        models.Forum.objects.filter(pk=f1.pk).update(title="renamed again")
+        models.Forum.objects.filter(pk=f1.pk).update(title="renamed once more")
+        self.assertEqual(sorted(post_markers.values_list('tag', flat=True)), [tag, tag + 1])
+
+        sink = metrics.PrometheusSink()
+        metrics.set_sink(sink)
+        try:
+            denorm.flush()
+        finally:
+            metrics.set_sink(None)
+        self.assertFalse(DirtyInstance.objects.exists())
+        self.assertEqual(sink.counters[('denorm_rows_written_total', (('model', 'test_app.post'),))], 1)
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "renamed once more")
+
+    def test_flush_shards(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(4)]
+        posts = [models.Post.objects.create(forum=f) for f in forums]
+        denorm.flush()
+
+        models.Forum.objects.update(title="renamed")
+        denorm.flush(shard=(0, 2))
+        self.assertEqual(
+            set(DirtyInstance.objects.values_list('object_id', flat=True)),
+            set(post.pk for post in posts if post.pk % 2) | set(forum.pk for forum in forums if forum.pk % 2),
+        )
+
+        denorm.flush(shard=(1, 2))
+        self.assertFalse(DirtyInstance.objects.exists())
+        for post in posts:
+            self.assertEqual(models.Post.objects.get(id=post.id).forum_title, "renamed")
+
+    def test_flush_max_passes(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        models.Post.objects.create(forum=f1)
+        denorm.flush()
+        models.Forum.objects.filter(pk=f1.pk).update(title="forumtwo")
+        markers = DirtyInstance.objects.count()
+
+        warnings = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+
+        handler = Handler(logging.WARNING)
+        max_passes = denorms.FLUSH_MAX_PASSES
+        denorms.logger.addHandler(handler)
+        denorms.FLUSH_MAX_PASSES = 0
+        try:
+            self.assertEqual(denorm.flush(), 0)
+        finally:
+            denorms.FLUSH_MAX_PASSES = max_passes
+            denorms.logger.removeHandler(handler)
+        self.assertEqual(DirtyInstance.objects.count(), markers)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('%s dirty markers' % markers, warnings[0])
+
+        self.assertTrue(denorm.flush() >= markers)
+        self.assertFalse(DirtyInstance.objects.exists())
+
+    def test_metrics(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        denorm.flush()
+
+        path = os.path.join(tempfile.mkdtemp(), 'denorm.prom')
+        sink = metrics.PrometheusTextFileSink(path)
+        metrics.set_sink(sink)
+        try:
+            models.Forum.objects.filter(pk=f1.pk).update(title="forumtwo")
+            self.assertTrue(denorms.oldest_marker_age() >= 0)
+            denorm.flush()
+        finally:
+            metrics.set_sink(None)
+
+        markers = sink.counters[('denorm_markers_processed_total', (('content_type', 'test_app.post'),))]
+        self.assertTrue(markers > 0)
+        self.assertEqual(sink.counters[('denorm_rows_written_total', (('model', 'test_app.post'),))], 1)
+        self.assertTrue(('denorm_callback_seconds_total', (('field', 'test_app.post.forum_title'),)) in sink.counters)
+        self.assertEqual(sink.gauges[('denorm_oldest_marker_age_seconds', ())], 0)
+        with open(path) as f:
+            self.assertTrue('denorm_markers_processed_total{content_type="test_app.post"} %s\n' % markers in f.read())
+
+        server = metrics.serve(0, sink)
+        try:
+            self.assertEqual(server.server_address[0], '127.0.0.1')
+        finally:
+            server.shutdown()
+
+    def test_status(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f1)
+        denorm.flush()
+        models.Forum.objects.filter(pk=f1.pk).update(title="forumtwo")
+        models.Post.objects.filter(pk=p1.pk).update(title="postone")
+
+        out = StringIO()
+        call_command('denorm_status', json=True, sample=0, top=1, stdout=out)
+        status = json.loads(out.getvalue())
+        markers = DirtyInstance.objects.count()
+        self.assertEqual(status['markers'], markers)
+        self.assertTrue(0 < status['objects'] < markers)
+        self.assertTrue(0 < status['duplicate_ratio'] < 1)
+        self.assertTrue(status['oldest_age'] >= status['newest_age'] >= 0)
+        self.assertEqual(sum(row['markers'] for row in status['content_types']), markers)
+        self.assertEqual(len(status['hot_objects']), 1)
+        self.assertEqual(status['eta'], None)
+
+        # Sampling is opt-in and markers of removed models are reported too.
+        content_type = ContentType.objects.create(app_label='removed_app', model='removedmodel')
+        DirtyInstance.objects.create(content_type=content_type, object_id=1)
+        out = StringIO()
+        call_command('denorm_status', json=True, stdout=out)
+        status = json.loads(out.getvalue())
+        self.assertEqual(status['throughput'], None)
+        self.assertIn('removed_app.removedmodel', [row['content_type'] for row in status['content_types']])
+
+        call_command('denorm_status', stdout=StringIO())
+
+    def test_flush_skip_locked(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        models.Forum.objects.update(title="forumtwo")
+
+        if not triggers.supports_skip_locked(connection):
+            self.assertRaises(NotImplementedError, denorm.flush, skip_locked=True)
+            return
+
+        denorm.flush(skip_locked=True)
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "forumtwo")
+        self.assertFalse(DirtyInstance.objects.exists())
+
+    def test_flush_skip_locked_sql(self):
+        # Runs the claim queries of flush() and compact() with SKIP LOCKED,
+        # dropping the clause where the database does not support it.
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        models.Forum.objects.update(title="forumtwo")
+        supported = triggers.supports_skip_locked(connection)
+        claims = []
+
+        class Cursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def execute(self, sql, params=None):
+                if sql.endswith(' FOR UPDATE SKIP LOCKED'):
+                    claims.append(sql.split(' FROM ')[1].split()[0])
+                    if not supported:
+                        sql = sql[:-len(' FOR UPDATE SKIP LOCKED')]
+                return self.cursor.execute(sql, params)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        class Connection(object):
+            def cursor(self):
+                return Cursor(connection.cursor())
+
+            def __getattr__(self, name):
+                return getattr(connection, name)
+
+        supports_skip_locked = triggers.supports_skip_locked
+        denorms.connection = Connection()
+        triggers.supports_skip_locked = lambda connection: True
+        try:
+            denorm.flush(skip_locked=True)
+            self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "forumtwo")
+            models.Post.objects.create(forum=f1)
+            models.Forum.objects.update(title="forumthree")
+            denorm.flush(skip_locked=True, max_items=100)
+        finally:
+            denorms.connection = connection
+            triggers.supports_skip_locked = supports_skip_locked
+        self.assertEqual(models.Post.objects.get(id=p1.id).forum_title, "forumthree")
+        self.assertEqual(models.Forum.objects.get(id=f1.id).deferred_post_count, 2)
+        self.assertFalse(AggregateDelta.objects.exists())
+        qn = connection.ops.quote_name
+        self.assertIn(qn(DirtyInstance._meta.db_table), claims)
+        self.assertIn(qn(AggregateDelta._meta.db_table), claims)
+
+    def test_notify_trigger(self):
+        with self.settings(DENORM_NOTIFY_CHANNEL='denorm'):
+            if connection.vendor != 'postgresql':
+                self.assertRaises(NotImplementedError, denorms.build_triggerset)
+                return
+            triggerset = denorms.build_triggerset()
+        self.assertTrue('denorm_after_statement_insert_on_denorm_dirtyinstance' in triggerset.triggers)
+
     def test_no_dependency(self):
         m1 = models.Member.objects.create(first_name="first", name="last")
         denorm.flush()
@@ -279,6 +857,25 @@ class TestDenormalisation(TestCase):
         self.assertEqual(models.Post.objects.get(id=p3.id).response_count, 0)
         self.assertEqual(models.Post.objects.get(id=p4.id).response_count, 0)
 
+    def test_backward_relation_old_parent(self):
+        # The triggers must mark the parent a row pointed to before the
+        # change, even if it was changed without the ORM.
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f1)
+        p3 = models.Post.objects.create(forum=f1, response_to=p1)
+        denorm.flush()
+        self.assertEqual(models.Post.objects.get(id=p1.id).response_count, 1)
+
+        models.Post.objects.filter(pk=p3.pk).update(response_to=p2)
+        denorm.flush()
+        self.assertEqual(models.Post.objects.get(id=p1.id).response_count, 0)
+        self.assertEqual(models.Post.objects.get(id=p2.id).response_count, 1)
+
+        models.Post.objects.filter(pk=p3.pk).delete()
+        denorm.flush()
+        self.assertEqual(models.Post.objects.get(id=p2.id).response_count, 0)
+
     def test_m2m_relation(self):
         f1 = models.Forum.objects.create(title="forumone")
         p1 = models.Post.objects.create(forum=f1, title="post1")
@@ -424,6 +1021,389 @@ class TestDenormalisation(TestCase):
         self.assertEqual(f1.post_count, 1)
         self.assertEqual(f1.authors.all()[0], m1)
 
+    def test_denorm_rebuild_chunks(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        models.Forum.objects.update(post_count=0)
+        models.Post.objects.update(forum_title='')
+
+        denorm.denorms.rebuildall(chunk_size=2)
+
+        for forum in forums:
+            self.assertEqual(models.Forum.objects.get(id=forum.id).post_count, 1)
+            self.assertEqual(models.Post.objects.get(forum=forum).forum_title, forum.title)
+
+    def test_denorm_rebuild_ranges(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        models.Forum.objects.update(post_count=0)
+
+        ranges = denorms.get_pk_ranges(models.Forum, 2)
+        self.assertEqual(ranges[0][0], forums[0].pk)
+        self.assertEqual(ranges[-1][1], forums[-1].pk)
+        for (min_pk, max_pk), (next_min_pk, next_max_pk) in zip(ranges, ranges[1:]):
+            self.assertEqual(max_pk + 1, next_min_pk)
+
+        # the ranges are rebuilt the way a worker process of rebuildall(jobs=N) does
+        for min_pk, max_pk in ranges:
+            task = ('test_app', 'Forum', ['post_count'], min_pk, max_pk, 2)
+            self.assertEqual(denorms.rebuild_range(task), (task, None))
+        for forum in forums:
+            self.assertEqual(models.Forum.objects.get(id=forum.id).post_count, 1)
+
+        task = ('test_app', 'Missing', ['post_count'], None, None, 2)
+        self.assertTrue(denorms.rebuild_range(task)[1])
+
+    def test_rebuild_parallel_connections(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        models.Post.objects.create(forum=f1)
+        post_denorms = [
+            d for d in denorms.alldenorms
+            if d.model is models.Post and not isinstance(d, denorms.AggregateDenorm)
+        ]
+        closed = []
+
+        class Connection(object):
+            def __init__(self, alias):
+                self.alias = alias
+
+            def close(self):
+                closed.append(self.alias)
+
+        class Connections(object):
+            def all(self):
+                return [Connection('default'), Connection('other')]
+
+        class Forked(Exception):
+            pass
+
+        def pool(jobs):
+            raise Forked(list(closed))
+
+        connections, Pool = denorms.connections, denorms.multiprocessing.Pool
+        denorms.connections, denorms.multiprocessing.Pool = Connections(), pool
+        try:
+            denorms.rebuild_parallel({models.Post: post_denorms}, None, 2)
+        except Forked, e:
+            self.assertEqual(e.args[0], ['default', 'other'])
+        else:
+            self.fail('no pool was started')
+        finally:
+            denorms.connections, denorms.multiprocessing.Pool = connections, Pool
+            RebuildCheckpoint.objects.all().delete()
+
+    def test_denorm_rebuild_resume(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        posts = [models.Post.objects.create(forum=f1) for i in range(4)]
+        models.Post.objects.update(forum_title='')
+        DirtyInstance.objects.all().delete()
+
+        # pretend an earlier rebuild got interrupted after the second post
+        post_denorms = [
+            d for d in denorms.alldenorms
+            if d.model is models.Post and not isinstance(d, denorms.AggregateDenorm)
+        ]
+        checkpoint = denorms.get_checkpoint(models.Post, post_denorms)
+        checkpoint.last_pk = unicode(posts[1].pk)
+        checkpoint.save()
+        # and an other one rebuilding the forums
+        forum_checkpoint = denorms.get_checkpoint(models.Forum, [models.Forum._meta.get_field('path').denorm])
+
+        denorms.rebuild_model(models.Post, post_denorms, 1, checkpoint=checkpoint)
+        titles = [models.Post.objects.get(id=post.id).forum_title for post in posts]
+        self.assertEqual(titles, ['', '', 'forumone', 'forumone'])
+        checkpoint = RebuildCheckpoint.objects.get(pk=checkpoint.pk)
+        self.assertEqual(checkpoint.last_pk, unicode(posts[-1].pk))
+        self.assertTrue(checkpoint.done)
+
+        self.assertRaises(CommandError, call_command, 'denorm_rebuild', 'Post')
+        call_command('denorm_rebuild', 'Post', resume=True)
+        self.assertEqual(list(RebuildCheckpoint.objects.all()), [forum_checkpoint])
+
+        call_command('denorm_rebuild', 'Post')
+        titles = [models.Post.objects.get(id=post.id).forum_title for post in posts]
+        self.assertEqual(titles, ['forumone'] * 4)
+        self.assertEqual(list(RebuildCheckpoint.objects.all()), [forum_checkpoint])
+
+    def test_deferred_count(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        m1 = models.Member.objects.create(name="memberone")
+        p1 = models.Post.objects.create(forum=f1, author=m1)
+        models.Post.objects.create(forum=f1, author=m1)
+
+        # The triggers only recorded the changes.
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).deferred_post_count, 0)
+        self.assertEqual(denorm.exact_value(f1, 'deferred_post_count'), 2)
+        self.assertEqual(denorm.exact_value(f1, 'post_count'), 2)
+        self.assertEqual(denorm.audit(model_name='Forum', field_name='deferred_post_count')[0]['drifted'], 0)
+
+        # Updates that do not change the count leave no deltas behind.
+        pending = AggregateDelta.objects.count()
+        p1.title = "renamed"
+        p1.save()
+        self.assertEqual(AggregateDelta.objects.count(), pending)
+
+        p1.forum = f2
+        p1.save()
+        self.assertEqual(denorm.exact_value(f1, 'deferred_post_count'), 1)
+        self.assertEqual(denorm.exact_value(f2, 'deferred_post_count'), 1)
+
+        denorm.flush()
+        self.assertFalse(AggregateDelta.objects.exists())
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).deferred_post_count, 1)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).deferred_post_count, 1)
+
+        p1.delete()
+        self.assertEqual(denorm.compact(max_seconds=0), 0)
+        self.assertEqual(denorm.compact(), 1)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).deferred_post_count, 0)
+
+        models.Post.objects.create(forum=f2, author=m1)
+        models.Forum.objects.update(deferred_post_count=5)
+        denorm.rebuildall(model_name='Forum', field_name='deferred_post_count')
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).deferred_post_count, 1)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).deferred_post_count, 1)
+
+    def test_statement_triggers_sql(self):
+        # Only PostgreSQL 10+ can run them, check the generated SQL.
+        from denorm.db.postgresql import triggers as pg_triggers
+        denorm_ = models.Forum._meta.get_field('post_count').denorm
+        denorms.triggers = pg_triggers
+        try:
+            trigger_list = denorm_.get_statement_triggers(None)
+        finally:
+            denorms.triggers = triggers
+        sql = dict((trigger.event, trigger.sql()[0]) for trigger in trigger_list)
+
+        self.assertIn('REFERENCING OLD TABLE AS denorm_old NEW TABLE AS denorm_new', sql['update'])
+        self.assertIn('REFERENCING NEW TABLE AS denorm_new\n', sql['insert'])
+        self.assertIn('REFERENCING OLD TABLE AS denorm_old\n', sql['delete'])
+        for event in sql:
+            self.assertIn('FOR EACH STATEMENT', sql[event])
+            self.assertIn('GROUP BY denorm_key', sql[event])
+            self.assertNotIn('NEW.', sql[event])
+            self.assertNotIn('OLD.', sql[event])
+        self.assertIn('UNION ALL', sql['update'])
+
+    def test_insert_action_connection(self):
+        # The ON CONFLICT check must look at the trigger's own connection.
+        from denorm.db.postgresql import triggers as pg_triggers
+
+        class Server(object):
+            def __init__(self, pg_version):
+                self.pg_version = pg_version
+
+        action = pg_triggers.TriggerActionInsert(DirtyInstance, ['object_id'], ['NEW.id'])
+        trigger = pg_triggers.Trigger(models.Post, 'after', 'update', [action], 1)
+        self.assertIs(action.connection, trigger.connection)
+
+        trigger.connection = Server(90500)
+        trigger.append(action)
+        self.assertIn('ON CONFLICT DO NOTHING', action.sql()[0])
+
+        trigger.connection = Server(90400)
+        trigger.append(action)
+        sql = action.sql()[0]
+        self.assertNotIn('ON CONFLICT', sql)
+        self.assertIn('EXCEPTION WHEN unique_violation', sql)
+
+    def test_aggregate_rebuild(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        models.Post.objects.create(forum=f1)
+        models.Post.objects.create(forum=f1)
+        models.Forum.objects.update(post_count=7)
+
+        post_count = [d for d in denorms.alldenorms if d.model is models.Forum and d.fieldname == 'post_count'][0]
+        post_count.rebuild()
+
+        self.assertEqual(models.Forum.objects.get(id=f1.id).post_count, 2)
+        self.assertEqual(models.Forum.objects.get(id=f2.id).post_count, 0)
+
+    def test_audit(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f2)
+        denorm.flush()
+        models.Forum.objects.filter(pk=f2.pk).update(post_count=5)
+        models.Post.objects.filter(pk=p1.pk).update(forum_title='wrong')
+        DirtyInstance.objects.all().delete()
+
+        report = dict(((row['model'], row['field']), row) for row in denorm.audit())
+        self.assertEqual(report[('test_app.forum', 'post_count')]['checked'], 2)
+        self.assertEqual(report[('test_app.forum', 'post_count')]['drifted'], 1)
+        self.assertEqual(report[('test_app.forum', 'post_count')]['examples'], [f2.pk])
+        self.assertEqual(report[('test_app.post', 'forum_title')]['examples'], [p1.pk])
+        self.assertEqual(report[('test_app.post', 'forum_title')]['drift_rate'], 0.5)
+        self.assertFalse(('test_app.forum', 'cachekey') in report)
+
+        report = denorm.audit(model_name='Post', field_name='forum_title', sample=1)
+        self.assertEqual(report[0]['checked'], 1)
+
+        # nothing was written
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).post_count, 5)
+        self.assertEqual(models.Post.objects.get(pk=p1.pk).forum_title, 'wrong')
+        self.assertFalse(DirtyInstance.objects.exists())
+
+        out = StringIO()
+        call_command('denorm_audit', 'Forum', field_name='post_count', sample=10, stdout=out)
+        self.assertTrue('test_app.forum.post_count: 1 of 2 drifted' in out.getvalue())
+
+    def test_batch_callback(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1)
+        p2 = models.Post.objects.create(forum=f1)
+        m1 = models.Member.objects.create(name="memberone")
+        m2 = models.Member.objects.create(name="membertwo")
+        self.assertEqual(m1.bookmark_count, 0)
+
+        m1.bookmarks.add(p1, p2)
+        m2.bookmarks.add(p2)
+        denorm.flush()
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).bookmark_count, 2)
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).bookmark_count, 1)
+
+        m1.bookmarks.clear()
+        denorm.flush()
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).bookmark_count, 0)
+
+        models.Member.objects.update(bookmark_count=5)
+        denorm.denorms.rebuildall(model_name='Member', field_name='bookmark_count')
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).bookmark_count, 0)
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).bookmark_count, 1)
+
+        # Markers for other fields do not call the batch callback.
+        batches = []
+        denorm_ = models.Member._meta.get_field('bookmark_count').denorm
+        batch_func = denorm_.batch_func
+        denorm_.batch_func = lambda members: batches.append(members) or batch_func(members)
+        DirtyInstance.objects.create(
+            content_type=ContentType.objects.get_for_model(models.Member),
+            object_id=m1.pk, field_name='bookmark_titles',
+        )
+        try:
+            denorm.flush()
+        finally:
+            denorm_.batch_func = batch_func
+        self.assertEqual(batches, [])
+
+    def test_expression_models_load(self):
+        # Declaring the fields must not look up fields of the queryset's
+        # model while the models are still being loaded, see
+        # denormalized_expression. The callable is only called later on.
+        calls = []
+
+        def queryset():
+            calls.append(1)
+            return models.Post.objects.values_list('title')
+        denorm.denormalized_expression(django.db.models.CharField, queryset, 'Post.author', max_length=255)
+        self.assertEqual(calls, [])
+
+        # The reverse relations of the models loaded with such fields are complete.
+        self.assertEqual(models.Post._meta.get_field_by_name('member')[0].model, models.Member)
+
+    def test_expression(self):
+        m1 = models.Member.objects.create(name="memberone")
+        m2 = models.Member.objects.create(name="membertwo")
+        self.assertEqual(m1.latest_post_title, '')
+
+        f1 = models.Forum.objects.create(title="forumone")
+        models.Post.objects.create(forum=f1, author=m1, title="postone")
+        p2 = models.Post.objects.create(forum=f1, author=m1, title="posttwo")
+        denorm.flush()
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).latest_post_title, 'posttwo')
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).latest_post_title, '')
+
+        p2.author = m2
+        p2.save()
+        denorm.flush()
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).latest_post_title, 'postone')
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).latest_post_title, 'posttwo')
+
+        p2.delete()
+        denorm.flush()
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).latest_post_title, '')
+
+        models.Member.objects.update(latest_post_title='wrong')
+        DirtyInstance.objects.all().delete()
+        denorm.denorms.rebuildall(model_name='Member', field_name='latest_post_title')
+        self.assertEqual(models.Member.objects.get(pk=m1.pk).latest_post_title, 'postone')
+        self.assertEqual(models.Member.objects.get(pk=m2.pk).latest_post_title, '')
+
+    def test_immediate_expression(self):
+        m1 = models.Member.objects.create(name="memberone")
+        m2 = models.Member.objects.create(name="membertwo")
+        self.assertFalse(m1.has_posts)
+
+        f1 = models.Forum.objects.create(title="forumone")
+        p1 = models.Post.objects.create(forum=f1, author=m1, title="postone")
+        # No flush() needed, the triggers updated the members already.
+        self.assertTrue(models.Member.objects.get(pk=m1.pk).has_posts)
+        self.assertFalse(models.Member.objects.get(pk=m2.pk).has_posts)
+        self.assertFalse(DirtyInstance.objects.filter(field_name='has_posts').exists())
+
+        p1.author = m2
+        p1.save()
+        self.assertFalse(models.Member.objects.get(pk=m1.pk).has_posts)
+        self.assertTrue(models.Member.objects.get(pk=m2.pk).has_posts)
+
+        p1.delete()
+        self.assertFalse(models.Member.objects.get(pk=m2.pk).has_posts)
+
+        models.Post.objects.create(forum=f1, author=m1, title="posttwo")
+        models.Member.objects.update(has_posts=False)
+        denorm.denorms.rebuildall(model_name='Member', field_name='has_posts')
+        self.assertTrue(models.Member.objects.get(pk=m1.pk).has_posts)
+        self.assertFalse(models.Member.objects.get(pk=m2.pk).has_posts)
+
+    def test_immediate_expression_sql(self):
+        # PostgreSQL checks the types of COALESCE() when the trigger runs,
+        # the selected value must be a boolean like the default.
+        from denorm.db.postgresql import triggers as pg_triggers
+        denorm_ = models.Member._meta.get_field('has_posts').denorm
+        denorms.triggers = pg_triggers
+        try:
+            trigger_list = denorm_.get_triggers(None)
+        finally:
+            denorms.triggers = triggers
+        for trigger in trigger_list:
+            sql = trigger.sql()[0]
+            self.assertIn('COALESCE((SELECT (TRUE) AS', sql)
+            self.assertIn('), FALSE)', sql)
+
+    def test_expression_default_backslash(self):
+        # MySQL needs the backslash escaped in the trigger SQL, SQLite and
+        # PostgreSQL take it literally.
+        from denorm.db import base
+        from denorm.db.mysql import triggers as mysql_triggers
+        field = models.Member._meta.get_field('latest_post_title')
+        denorm_, default = field.denorm, field.default
+        field.default = "it's C:\\"
+        denorms.triggers = mysql_triggers
+        try:
+            sql, params = denorm_.get_expression_sql(None, literal_default=True)
+        finally:
+            denorms.triggers = triggers
+            field.default = default
+        self.assertTrue(sql.endswith(", 'it''s C:\\\\')"))
+        self.assertEqual(base.literal_sql('C:\\'), "'C:\\'")
+
+    def test_immediate_expression_filter(self):
+        if connection.vendor != 'sqlite':
+            return
+        self.assertRaises(
+            NotImplementedError, denorm.denormalized_expression, django.db.models.BooleanField,
+            models.Post.objects.filter(title='postone').values_list('pk'), 'author', immediate=True)
+
+    def test_expression_joining_own_model(self):
+        denorm_ = copy.copy(models.Member._meta.get_field('latest_post_title').denorm)
+        denorm_.expression = (models.Post.objects.filter(author__name='memberone').values_list('title'), 'author')
+        self.assertRaises(ValueError, denorm_.get_expression_sql, None)
+
     def test_denorm_update(self):
         f1 = models.Forum.objects.create(title="forumone")
         m1 = models.Member.objects.create(name="memberone")